@@ -0,0 +1,226 @@
+#   Waterbug, a modular IRC bot written using Python 3
+#   Copyright (C) 2011  ecryth
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Micro-benchmarks for the hot paths of the bot, run with `python benchmark.py [name...]`"""
+
+import asyncio
+import sys
+import timeit
+import tracemalloc
+
+import waterbug
+from waterbug import commands, network, protocol
+
+LINES = [
+    b":nick!~ident@host.example.org PRIVMSG #channel :hello there, how is everyone doing today?",
+    b":server.example.org 353 Waterbug = #channel :@op +voiced user1 user2 user3 user4 user5",
+    b":server.example.org 354 Waterbug ~ident host.example.org nick H account :Real Name",
+    b":nick!~ident@host.example.org JOIN #channel",
+    b"@time=2015-01-01T00:00:00.000Z;account=acc :nick!~ident@h.example PRIVMSG #c :tagged",
+    b"PING :server.example.org",
+    ":nïck!~ident@host PRIVMSG #channel :non-ascii payload åäö".encode("utf-8"),
+]
+
+
+def legacy_parse(data):
+    """The string handling formerly done inline in Server.read"""
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError:
+        text = data.decode("latin", "replace")
+
+    if not text.startswith(":"):
+        return None, text.split(' ')
+
+    username, msgtype, *parameters = text[1:].split(' ')
+    try:
+        username, host = username.split('!', 2)
+    except ValueError:
+        host = None
+    ident = None
+    if host is not None:
+        ident, host = host.split("@", 2)
+    for i, v in enumerate(parameters):
+        if v.startswith(":"):
+            parameters[i:] = [' '.join([v[1:]] + parameters[i + 1:])]
+            break
+    return msgtype, parameters
+
+def parse(data):
+    return protocol.parse(protocol.decode(data))
+
+
+def bench_parse(number=20000):
+    for name, func in (("legacy", legacy_parse), ("protocol.parse", parse)):
+        elapsed = timeit.timeit(lambda: [func(line) for line in LINES], number=number)
+        print("{:>16}: {:8.0f} lines/s".format(name, number * len(LINES) / elapsed))
+
+
+def make_server(channelname="#channel"):
+    server = network.Server("%", "irc.example.org", 6667, "bench", "Waterbug",
+                            loop=asyncio.new_event_loop())
+    server.receiver("005", None, "Waterbug", "PREFIX=(ov)@+", "CHANTYPES=#",
+                    "CASEMAPPING=rfc1459", "are supported by this server")
+    server.receiver("001", "irc.example.org", "Waterbug", "Welcome")
+    server.receiver("JOIN", server.ownuser, channelname)
+    server.message_queue = network.MessageQueue()
+    return server
+
+def bench_casemapping(members=10000, number=10):
+    names = ["User[{}]".format(i) for i in range(members)]
+    batches = [" ".join(names[i:i + 400]) for i in range(0, members, 400)]
+
+    def names_reply():
+        server = make_server()
+        for batch in batches:
+            server.receiver("353", "irc.example.org", "Waterbug", "=", "#channel", batch)
+        server.receiver("366", "irc.example.org", "Waterbug", "#channel", "End of /NAMES list.")
+        return server
+
+    elapsed = timeit.timeit(names_reply, number=number)
+    print("{:>16}: {:8.0f} names/s".format("353", number * members / elapsed))
+
+    # the lookups done by Waterbug.handle_queued_messages for each queued message
+    server = names_reply()
+    servers = {"bench": server}
+    def queued_lookup():
+        if "bench" in servers and "#CHANNEL" in servers["bench"].channels:
+            return next((u for u in servers["bench"].channels["#channel"].users.values()
+                         if u.account == "nobody"), None)
+
+    elapsed = timeit.timeit(queued_lookup, number=number)
+    print("{:>16}: {:8.0f} members/s".format("queued lookup", number * members / elapsed))
+
+    lookups = [name.upper() for name in names]
+    elapsed = timeit.timeit(lambda: [name in server.users for name in lookups], number=number)
+    print("{:>16}: {:8.0f} lookups/s".format("users lookup", number * members / elapsed))
+
+
+def bench_dispatch(number=2000):
+    server = make_server()
+    lines = [b":nick!~ident@host PRIVMSG #channel :hello", b":nick!~ident@host NOTICE #channel :hi",
+             b":server.example.org 372 Waterbug :- motd", b":server.example.org 999 Waterbug :?"]
+    server.add_callback(lambda *args: None, {"PRIVMSG"})
+    elapsed = timeit.timeit(lambda: [server.handle_line(line) for line in lines], number=number)
+    print("{:>16}: {:8.0f} lines/s".format("handle_line", number * len(lines) / elapsed))
+    for messagetype, calls, seconds in server.message_stats():
+        print("{:>16}: {:8d} calls, {:6.1f} us/call".format(messagetype, calls, seconds / calls * 1e6))
+
+
+class BenchCommands(waterbug.Commands):
+
+    @waterbug.expose
+    def ping(responder):
+        pass
+
+    @waterbug.expose(aliases=("g",))
+    class group:
+
+        @waterbug.expose
+        def _default(responder, *args):
+            pass
+
+        @waterbug.expose
+        def subcommand(responder, arg):
+            pass
+
+# a realistic number of other commands to look through
+for i in range(50):
+    setattr(BenchCommands, "command{}".format(i),
+            waterbug.expose(name="command{}".format(i))(lambda responder: None))
+
+def legacy_get_command(tree, args):
+    """The nested dict walk formerly done by Waterbug.get_command"""
+    commands = tree
+    command_length = 0
+    while (command_length < len(args) and isinstance(commands, dict)
+            and args[command_length] in commands):
+        commands = commands[args[command_length]]
+        command_length += 1
+    if callable(commands):
+        return commands, args[command_length:]
+    elif isinstance(commands, dict) and callable(commands.get("_default")):
+        return commands["_default"], args[command_length:]
+    raise LookupError("Couldn't find a matching command")
+
+def bench_commands(number=20000):
+    trie = commands.compile_commands([BenchCommands])
+    tree = {name: node.func for name, node in trie.children.items() if not node.group}
+    tree["group"] = {"_default": trie.children["group"].func,
+                     "subcommand": trie.children["group"].children["subcommand"].func}
+    messages = ["ping", "group subcommand argument", "g some words here", "subcom x",
+                "not a command at all, just someone talking", "o/"]
+
+    def legacy():
+        for message in messages:
+            try:
+                legacy_get_command(tree, message.split(" "))
+            except LookupError:
+                pass
+
+    def compiled():
+        for message in messages:
+            if trie.accepts(message):
+                try:
+                    trie.resolve(message.split(" "))
+                except LookupError:
+                    pass
+
+    for name, func in (("legacy", legacy), ("trie", compiled)):
+        elapsed = timeit.timeit(func, number=number)
+        print("{:>16}: {:6.2f} us/message".format(name, elapsed / number / len(messages) * 1e6))
+    elapsed = timeit.timeit(lambda: trie.accepts(messages[-2]), number=number)
+    print("{:>16}: {:6.2f} us/message".format("reject", elapsed / number * 1e6))
+
+
+def bench_memory(members=100000):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    server = make_server()
+    names = ["user{}".format(i) for i in range(members)]
+    for i in range(0, members, 400):
+        server.receiver("353", "irc.example.org", "Waterbug", "=", "#channel",
+                        " ".join(names[i:i + 400]))
+    server.receiver("366", "irc.example.org", "Waterbug", "#channel", "End of /NAMES list.")
+    for i, name in enumerate(names):
+        server.receiver("354", "irc.example.org", "Waterbug", "~" + name,
+                        "gateway/web/irccloud.com/x-{}".format(i % 5000), name, "H",
+                        name if i % 3 == 0 else "0", "Real Name")
+    server.receiver("315", "irc.example.org", "Waterbug", "#channel", "End of /WHO list.")
+
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    print("{:>16}: {:8.1f} MB, {:.0f} bytes/member".format(
+        "{} members".format(members), size / 2 ** 20, size / members))
+
+
+BENCHMARKS = {
+    "parse": bench_parse,
+    "casemapping": bench_casemapping,
+    "commands": bench_commands,
+    "dispatch": bench_dispatch,
+    "memory": bench_memory,
+}
+
+def main(*names):
+    for name in names or sorted(BENCHMARKS):
+        print("[{}]".format(name))
+        BENCHMARKS[name]()
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -16,18 +16,29 @@
 
 import asyncio
 import logging
+import logging.handlers
+import queue
 import sys
 
 import waterbug
 
 def main(*argv):
 
-    logging.basicConfig(format="%(asctime)s [%(name)s] %(message)s", datefmt="[%H:%M:%S]",
-                        level=logging.INFO, stream=sys.stdout)
+    # records are written by a background thread, so a slow terminal doesn't block the event loop
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(asctime)s [%(name)s] %(message)s", "[%H:%M:%S]"))
+    log_queue = queue.Queue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+
+    logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(log_queue)])
     logging.getLogger('asyncio').setLevel(logging.WARNING)
 
-    bot = waterbug.Waterbug()
-    asyncio.get_event_loop().run_until_complete(bot.run())
+    listener.start()
+    try:
+        bot = waterbug.Waterbug()
+        asyncio.get_event_loop().run_until_complete(bot.run())
+    finally:
+        listener.stop()
 
 if __name__ == "__main__":
     main(*sys.argv)
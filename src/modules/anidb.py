@@ -15,6 +15,7 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
+import collections
 import itertools
 import re
 import urllib.request
@@ -132,12 +133,16 @@ class Commands(waterbug.Commands):
                 for aid, targets in anidb.watchedtitles.items():
                     if title.startswith(anidb.titles[aid]["main"]["x-jat"][0]):
                         anidb.read_from_feed.add(entry["id"])
+                        channels = collections.defaultdict(list)
                         for (network, channel), wanted_group in targets.items():
                             if network in anidb.bot.servers and \
                                     channel in anidb.bot.servers[network].channels and \
                                     (wanted_group is None or wanted_group.lower() == group.lower()):
-                                anidb.bot.servers[network].msg(
-                                    channel, "New file added: {} - {}".format(title, link))
+                                channels[network].append(channel)
+                        for network, network_channels in channels.items():
+                            anidb.bot.servers[network].broadcast(
+                                network_channels, "New file added: {} - {}".format(title, link),
+                                priority=waterbug.BULK)
 
 
         def _search(animetitle, find_exact_match=False, limit=None):
@@ -15,8 +15,6 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
-import collections
-import inspect
 import io
 import itertools
 import sys
@@ -49,68 +47,30 @@ class Commands(waterbug.Commands):
     @waterbug.expose(name="help")
     def help_(responder, *args):
         """Displays help for the specified command"""
-
         try:
-            command, command_list, _arg = responder.bot.get_command(args)
+            node, _arg = responder.bot.commands.resolve(args)
             if len(_arg) > 0:
                 raise LookupError
-
-
-            # WARNING: somewhat ugly workaround to deal with coroutines wrapping functions, making
-            # the arg spec unavailable; if __wrapped__ is present, retreive the wrapped function
-            while hasattr(command, '__wrapped__'):
-                command = command.__wrapped__
-
-            argspec = inspect.getfullargspec(command)
-
-
-            if hasattr(command, "_argparser"):
-                responder("{}{} {}: {}".format(responder.server.prefix, ' '.join(command_list),
-                                               " ".join("[--{} {}]".format(k, v.__name__)
-                                                        for k, v in argspec.annotations.items()),
-                                               command.__doc__))
-            else:
-                cargs = argspec.args[1:] if argspec.defaults is None else argspec.args[1:-len(argspec.defaults)]
-                cdefaults = zip(argspec.args[len(cargs) + 1:], () if argspec.defaults is None else argspec.defaults)
-                signature = " ".join(x for x in [
-                    " ".join("<{}>".format(arg) for arg in cargs),
-                    " ".join("[{}={}]".format(arg, default) for arg, default in cdefaults),
-                    "[{}...]".format(argspec.varargs) if argspec.varargs is not None else ''
-                ] if len(x) > 0)
-
-                responder("{}{}{}{}: {}".format(responder.server.prefix, " ".join(command_list),
-                                                ' ' if signature else '', signature, command.__doc__))
+            responder(responder.server.prefix + node.help)
         except LookupError:
             responder("No such command: '{}'".format(responder.line))
 
     @waterbug.expose
     def commands(responder):
         """Displays all available commands"""
-        def flatten_dict(d):
-            for k, v in d.items():
-                if isinstance(v, collections.Mapping):
-                    subcommands = "|".join(sorted(flatten_dict(v)))
-                    if '_default' in v and responder.sender.access >= v['_default'].access:
-                        if len(subcommands) > 0:
-                            yield k + " [" + subcommands + "]"
-                        else:
-                            yield k
-                    elif len(subcommands) > 0:
-                        yield k + " <" + subcommands + ">"
-                    # output nothing if no accessible subcommands and _default not accessible
-                elif k != '_default' and responder.sender.access >= v.access:
-                    yield k
-
-        responder("Available commands: " + ', '.join(sorted(flatten_dict(responder.bot.commands))))
-
-
+        responder("Available commands: " +
+                  ', '.join(responder.bot.commands.listing(responder.sender.access)))
 
     @waterbug.expose
     @asyncio.coroutine
     def whoami(responder):
         """Displays your information such as username, hostname and access level"""
-        responder.server.who(responder.sender.username)
-        yield from responder.server.on("315")
+        try:
+            yield from asyncio.wait_for(responder.server.request_who(responder.sender.username),
+                                        waterbug.network.WHO_TIMEOUT)
+        except asyncio.TimeoutError:
+            responder("Error: WHO request failed")
+            return
         sender = responder.sender
         responder("You are {}!{}@{} ({}), {}, and you have access {}".format(
             sender.username, sender.ident, sender.hostname, sender.realname,
@@ -119,13 +79,39 @@ class Commands(waterbug.Commands):
             sender.access))
 
     @waterbug.expose(access=waterbug.ADMIN)
-    def access(responder, user, access_name):
-        # TODO: fix this ugly line
-        access_value = getattr(waterbug, access_name, None)
-        if type(access_value) is not int:
+    def stats(responder):
+        """Displays the message types this network sends us that take the most time to handle"""
+        stats = responder.server.message_stats()[:10]
+        responder("Most time consuming messages: " + ', '.join(
+            "{} ({} received, {:.3f}s)".format(*stat) for stat in stats))
+
+    @waterbug.expose(access=waterbug.ADMIN)
+    def traffic(responder):
+        """Writes the last raw lines sent to and received from the server to the log"""
+        lines = responder.server.dump_traffic()
+        for line in lines:
+            responder.server.logger.info("[Traffic] %s", line)
+        responder("Wrote {} lines of traffic to the log".format(len(lines)))
+
+    @waterbug.expose
+    def lag(responder):
+        """Displays the round-trip time to the server"""
+        server = responder.server
+        if server.lag is None:
+            responder("The lag hasn't been measured yet")
+            return
+        responder("Lag is {:.3f}s (median {:.3f}s, 95th percentile {:.3f}s) [{}]".format(
+            server.lag, server.lag_histogram.percentile(50) or 0,
+            server.lag_histogram.percentile(95) or 0, server.lag_histogram))
+
+    @waterbug.expose(access=waterbug.ADMIN)
+    def access(responder, mask, access_name):
+        """Sets the access of a hostname, nick!ident@host mask or $a:account"""
+        access_value = waterbug.ACCESS_LEVELS.get(access_name.upper())
+        if access_value is None:
             responder("Invalid access type")
             return
 
-        responder.bot.privileges[user] = access_value
-        responder("User {} is now {}".format(user, access_name))
+        responder.server.set_privilege(mask, access_value)
+        responder("{} is now {}".format(mask, access_name.upper()))
 
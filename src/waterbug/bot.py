@@ -18,7 +18,6 @@ __all__ = ['Waterbug', 'ArgumentParser', 'Commands', 'expose', 'trigger', 'perio
 
 import argparse
 import asyncio
-import collections
 import functools
 import glob
 import inspect
@@ -32,14 +31,14 @@ import types
 
 import jsonschema
 
-from . import network
+from . import commands, connection, network
 from .constants import *
 
 class Waterbug:
 
     def __init__(self, *, loop=None):
         self.servers = {}
-        self.commands = {}
+        self.commands = commands.compile_commands([])
         self.modules = []
         self.queued_messages = {}
         self.async_operations = {}
@@ -87,7 +86,37 @@ class Waterbug:
                             },
                             "quit_msg": { "type": "string" },
                             "inencoding": { "type": "string" },
-                            "outencoding": { "type": "string" }
+                            "outencoding": { "type": "string" },
+                            "flood_burst": { "type": "integer", "minimum": 1 },
+                            "flood_rate": { "type": "number", "exclusiveMinimum": True,
+                                            "minimum": 0 },
+                            "tracking": {
+                                "type": "string",
+                                "enum": ["full", "members-only", "none"]
+                            },
+                            "account_ttl": { "type": "number", "minimum": 0 },
+                            "pool_size": { "type": "integer", "minimum": 0 },
+                            "max_message_lines": { "type": "integer", "minimum": 1 },
+                            "tls": {
+                                "type": "object",
+                                "properties": {
+                                    "verify": {
+                                        "type": "string",
+                                        "enum": ["required", "optional", "none"]
+                                    },
+                                    "ca_file": { "type": "string" },
+                                    "certfile": { "type": "string" },
+                                    "keyfile": { "type": "string" }
+                                },
+                                "additionalProperties": False
+                            },
+                            "channel_tracking": {
+                                "type": "object",
+                                "additionalProperties": {
+                                    "type": "string",
+                                    "enum": ["full", "members-only", "none"]
+                                }
+                            }
                         },
                         "additionalProperties": False,
                         "required": ["prefix", "server", "port", "username"]
@@ -105,7 +134,7 @@ class Waterbug:
         for server_config in self.config['servers'].values():
             if 'privileges' in server_config:
                 for k, v in server_config['privileges'].items():
-                    server_config['privileges'][k] = globals()[v]
+                    server_config['privileges'][k] = ACCESS_LEVELS[v]
 
         self.loop = loop or asyncio.get_event_loop()
         self._future = None
@@ -122,14 +151,17 @@ class Waterbug:
     def open_connections(self):
         def _open_connection(server):
             def connection_closed(future):
-                if server.reconnect:
-                    logging.info("Reconnecting to %s", server.name)
-                    _open_connection(server)
-                else:
-                    logging.info("Removing %s from server list", server.name)
-                    del self.servers[server.name]
+                if not future.cancelled() and future.exception() is not None:
+                    e = future.exception()
+                    logging.error("Connection to %s failed", server.name,
+                                  exc_info=(type(e), e, e.__traceback__))
+                logging.info("Removing %s from server list", server.name)
+                del self.servers[server.name]
 
-            asyncio.async(server.connect(), loop=self.loop).add_done_callback(connection_closed)
+            asyncio.async(self.connections.manage(server),
+                          loop=self.loop).add_done_callback(connection_closed)
+
+        self.connections = connection.ConnectionManager(loop=self.loop)
 
         for name, config in self.config['servers'].items():
             server = network.Server(name=name, loop=self.loop, **config)
@@ -152,7 +184,7 @@ class Waterbug:
                 if getattr(module.commands.unload, "trigger", False):
                     module.commands.unload()
         self.modules = []
-        self.commands = {}
+        self.commands = commands.compile_commands([])
 
         for future in self.async_operations:
             future.cancel()
@@ -183,20 +215,18 @@ class Waterbug:
                 traceback.print_exc()
 
         for module in self.modules:
-            def add_commands(cls, command_dict):
+            def start_periodic_callbacks(cls):
                 for name, value in inspect.getmembers(cls):
-                    if getattr(value, "_exposed", False):
-                        if inspect.isfunction(value):
-                            command_dict[value.__name__] = value
-                        else:
-                            command_dict[name] = {}
-                            add_commands(value, command_dict[name])
+                    if getattr(value, "_exposed", False) and inspect.isclass(value):
+                        start_periodic_callbacks(value)
                     if getattr(value, "_period", None) is not None:
                         self.periodic_callbacks.append(value._period)
                         value._period.start()
 
             module.commands = module.Commands
-            add_commands(module.commands, self.commands)
+            start_periodic_callbacks(module.commands)
+
+        self.commands = commands.compile_commands(module.commands for module in self.modules)
 
     class ModuleStorage:
 
@@ -238,25 +268,8 @@ class Waterbug:
 
 
     def get_command(self, args):
-        commands = self.commands
-        command_length = 0
-
-        while (command_length < len(args)
-                and isinstance(commands, collections.Mapping)
-                and args[command_length] in commands):
-            commands = commands[args[command_length]]
-            command_length += 1
-
-        if callable(commands):
-            func = commands
-        elif (isinstance(commands, collections.Mapping)
-                and "_default" in commands
-                and callable(commands["_default"])):
-            func = commands["_default"]
-        else:
-            raise LookupError("Couldn't find a matching command")
-
-        return func, args[:command_length], args[command_length:]
+        node, args = self.commands.resolve(args)
+        return node.func, list(node.path), args
 
     def on_privmsg(self, server, event, sender, receiver, message):
         if receiver[0] in server.supported['CHANTYPES']:
@@ -265,29 +278,36 @@ class Waterbug:
             target = sender.username
         if message.startswith(server.prefix):
             message = message[len(server.prefix):]
+            # most lines starting with the prefix aren't commands, don't bother splitting those
+            if not self.commands.accepts(message):
+                return
 
             try:
-                func, _, args = self.get_command(message.split(" "))
+                node, args = self.commands.resolve(message.split(" "))
             except LookupError:
                 return
+            func = node.func
 
             if sender.access >= func.access:
                 responder = Waterbug.Responder(self, server, sender, target,
                                                receiver, " ".join(args))
 
+                # arguments that don't fit the command are reported without running it
+                try:
+                    args, kwargs = node.binder.bind(args)
+                except commands.UsageError as e:
+                    responder("{}, usage: {}{}".format(e, server.prefix, node.usage))
+                    return
+
                 @asyncio.coroutine
                 def run_func():
                     try:
-                        if hasattr(func, '_argparser'):
-                            flags = func._argparser.parse_args(args)
-                            res = func(responder, **vars(flags))
-                        else:
-                            res = func(responder, *args)
+                        res = func(responder, *args, **kwargs)
                         if asyncio.iscoroutine(res):
                             yield from res
-                    except (TypeError, ValueError):
-                        traceback.print_exc()
-                        responder("Wrong number of arguments")
+                    except commands.UsageError as e:
+                        # raised by commands that parse their arguments themselves
+                        responder(str(e))
                     except asyncio.CancelledError:
                         responder("Operation was cancelled: {}".format(self.async_operations[fut]))
                     except Exception as e:
@@ -318,7 +338,7 @@ class Waterbug:
                 if user is not None:
                     for message in messages:
                         self.servers[connection].msg(channel, "{}: {}".format(
-                            user.username, message))
+                            user.username, message), priority=BULK)
                     to_remove.add((connection, channel, account))
 
         for i in to_remove:
@@ -341,17 +361,19 @@ class Commands(metaclass=_MakeStatic):
 class ArgumentParser(argparse.ArgumentParser):
 
     def error(self, message):
-        raise ValueError(message)
+        raise commands.UsageError(message)
 
 def expose(*args, **kwargs):
     name = None
     access = STANDARD
     require_auth = False
     flags = False
+    aliases = ()
 
     def decorator(target):
         target._exposed = True
         target.access = access
+        target._aliases = tuple(aliases)
         if name is not None:
             target.__name__ = name
         if target.__doc__ is None:
@@ -359,32 +381,23 @@ def expose(*args, **kwargs):
 
         if flags:
             argspec = inspect.getfullargspec(target)
-            assert (len(argspec.args) == 1 and
+            assert (len(argspec.args) == 1 and argspec.varargs is None and
                     len(argspec.kwonlydefaults) == len(argspec.annotations) and
                     all(key in argspec.annotations for key in argspec.kwonlydefaults))
 
-            parser = ArgumentParser(add_help=False)
-            for arg in argspec.kwonlydefaults:
-                parser.add_argument('--' + arg, type=argspec.annotations[arg],
-                                    default=argspec.kwonlydefaults[arg])
-
-            target._argparser = parser
+            target._flags = True
 
         if require_auth:
             @asyncio.coroutine
             @functools.wraps(target)
             def new_target(responder, *args, **kwargs):
-                responder.server.who(responder.sender.username)
-                user = None
-                while user != responder.sender.username:
-                    try:
-                        _server, _mtype, _sender, _receiver, user, _message = \
-                            yield from asyncio.wait_for(responder.server.on("315"), 10)
-                    except asyncio.TimeoutError:
-                        responder("Error: WHO request failed")
-                        return
+                try:
+                    account = yield from responder.server.resolve_account(responder.sender)
+                except asyncio.TimeoutError:
+                    responder("Error: WHO request failed")
+                    return
 
-                if responder.sender.account is None:
+                if account is None:
                     responder("You need to be authenticated with services to use this command")
                 else:
                     yield from asyncio.coroutine(target)(responder, *args, **kwargs)
@@ -396,10 +409,10 @@ def expose(*args, **kwargs):
     if len(args) == 1 and len(kwargs) == 0 and (callable(args[0]) or inspect.isclass(args[0])):
         return decorator(args[0])
 
-    def get_args(name=None, access=STANDARD, require_auth=False, flags=False):
-        return name, access, require_auth, flags
+    def get_args(name=None, access=STANDARD, require_auth=False, flags=False, aliases=()):
+        return name, access, require_auth, flags, aliases
 
-    name, access, require_auth, flags = get_args(*args, **kwargs)
+    name, access, require_auth, flags, aliases = get_args(*args, **kwargs)
 
     return decorator
 
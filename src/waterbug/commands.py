@@ -0,0 +1,257 @@
+#   Waterbug, a modular IRC bot written using Python 3
+#   Copyright (C) 2011  ecryth
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['CommandNode', 'Binder', 'UsageError', 'compile_commands']
+
+import inspect
+
+# abbreviations shorter than this aren't recognized, so that the short triggers of other bots
+# don't run our commands by accident
+MIN_ABBREVIATION_LENGTH = 3
+
+
+class UsageError(ValueError):
+    """Raised when the arguments given to a command don't fit it"""
+
+
+def _abbreviations(names, min_length=1):
+    """Extends a dict of names with the prefixes of at least `min_length` characters that only
+    lead to one of its values"""
+    prefixes = {}
+    for name, value in names.items():
+        for length in range(min_length, len(name)):
+            prefixes.setdefault(name[:length], set()).add(value)
+    lookup = {prefix: values.pop() for prefix, values in prefixes.items() if len(values) == 1}
+    lookup.update(names)
+    return lookup
+
+def _convert(name, kind, value):
+    try:
+        return kind(value)
+    except ValueError:
+        raise UsageError("Invalid {}: '{}' is not {}".format(name, value, kind.__name__))
+
+
+class Binder:
+    """Binds the words following a command to the parameters of its function
+
+    It's compiled once from the signature of the function: positional parameters are filled in
+    order and varargs take the rest, while commands exposed with flags=True take --name value
+    pairs for their keyword-only parameters. Annotated parameters are converted with their
+    annotation. Nothing of the function runs until the arguments are known to fit it.
+    """
+
+    def __init__(self, func):
+        # coroutines wrapping functions make the arg spec unavailable; if __wrapped__ is
+        # present, retrieve the wrapped function
+        while hasattr(func, '__wrapped__'):
+            func = func.__wrapped__
+
+        argspec = inspect.getfullargspec(func)
+        annotations = argspec.annotations
+        # the first parameter is always the responder
+        names = argspec.args[1:]
+        defaults = argspec.defaults or ()
+
+        self.flags = getattr(func, "_flags", False)
+        self.required = len(names) - len(defaults)
+        self.parameters = [(name, annotations.get(name, str)) for name in names]
+        self.varargs = argspec.varargs
+        self.varargs_type = annotations.get(argspec.varargs, str)
+        self.options = {name: annotations.get(name, str) for name in argspec.kwonlyargs}
+        # options can be abbreviated to any unique prefix, as argparse allowed
+        self.option_names = _abbreviations({name: name for name in self.options})
+        # words are only converted if an annotation asks for something other than a string
+        self.typed = (any(kind is not str for _, kind in self.parameters) or
+                      self.varargs_type is not str)
+
+        if self.flags:
+            self.signature = " ".join("[--{} {}]".format(name, kind.__name__)
+                                      for name, kind in self.options.items())
+        else:
+            self.signature = " ".join(x for x in [
+                " ".join("<{}>".format(name) for name in names[:self.required]),
+                " ".join("[{}={}]".format(name, default)
+                         for name, default in zip(names[self.required:], defaults)),
+                "[{}...]".format(self.varargs) if self.varargs is not None else ''
+            ] if len(x) > 0)
+
+    def bind(self, args):
+        """Returns the positional and keyword arguments to call the function with"""
+        if self.flags:
+            return (), self.bind_flags(args)
+
+        if len(args) < self.required:
+            raise UsageError("Not enough arguments")
+        if self.varargs is None and len(args) > len(self.parameters):
+            raise UsageError("Too many arguments")
+        if not self.typed:
+            return args, {}
+
+        bound = [_convert(name, kind, arg) for (name, kind), arg in zip(self.parameters, args)]
+        bound.extend(_convert(self.varargs, self.varargs_type, arg)
+                     for arg in args[len(self.parameters):])
+        return bound, {}
+
+    def bind_flags(self, args):
+        kwargs = {}
+        args = iter(args)
+        for arg in args:
+            if not arg.startswith("--"):
+                raise UsageError("Unexpected argument '{}'".format(arg))
+            name, equals, value = arg[2:].partition("=")
+            if name not in self.option_names:
+                if any(option.startswith(name) for option in self.options):
+                    raise UsageError("Ambiguous option --{}".format(name))
+                raise UsageError("Unknown option --{}".format(name))
+            name = self.option_names[name]
+            if not equals:
+                value = next(args, None)
+                if value is None:
+                    raise UsageError("Option --{} needs a value".format(name))
+            kwargs[name] = _convert("--" + name, self.options[name], value)
+        return kwargs
+
+
+class CommandNode:
+    """A command, or a group of subcommands that may have a _default command
+
+    `lookup` maps the names, aliases and unique abbreviations of the subcommands of a group to
+    their nodes; it's filled in by compile once all the subcommands are known.
+    """
+
+    __slots__ = ('name', 'path', 'func', 'binder', 'children', 'aliases', 'lookup', '_listings',
+                 '_help')
+
+    def __init__(self, name, path, func=None, group=False):
+        self.name = name
+        self.path = path
+        self.func = func
+        self.binder = None
+        self.children = {} if group else None
+        self.aliases = {} if group else None
+        self.lookup = {}
+        self._listings = {}
+        self._help = None
+
+    @property
+    def group(self):
+        return self.children is not None
+
+    def add(self, node, aliases=()):
+        self.children[node.name] = node
+        for alias in aliases:
+            self.aliases[alias] = node
+
+    def compile(self):
+        if self.func is not None:
+            self.binder = Binder(self.func)
+        if not self.group:
+            return
+
+        # full names take precedence over aliases, which take precedence over abbreviations
+        self.lookup = dict(self.aliases, **self.children)
+        # a _default taking free text could start with any word, which mustn't be mistaken for
+        # an abbreviated subcommand
+        if self.binder is None or self.binder.varargs is None:
+            self.lookup = _abbreviations(self.lookup, MIN_ABBREVIATION_LENGTH)
+
+        for node in self.children.values():
+            node.compile()
+
+    def accepts(self, message):
+        """Returns False if no command can start `message`, without splitting all of it"""
+        return self.func is not None or message.partition(" ")[0] in self.lookup
+
+    def resolve(self, args):
+        """Returns the node of the command that `args` starts with and the arguments after it"""
+        node = self
+        length = 0
+        while node.group and length < len(args):
+            child = node.lookup.get(args[length])
+            if child is None:
+                break
+            node = child
+            length += 1
+
+        if node.func is None:
+            raise LookupError("Couldn't find a matching command")
+        return node, args[length:]
+
+    def listing(self, access):
+        """Returns the subcommands someone with `access` can use, as shown by `commands`"""
+        listing = self._listings.get(access)
+        if listing is None:
+            listing = self._listings[access] = sorted(self._list(access))
+        return listing
+
+    def _list(self, access):
+        for name, node in self.children.items():
+            if node.group:
+                subcommands = "|".join(node.listing(access))
+                if node.func is not None and access >= node.func.access:
+                    if len(subcommands) > 0:
+                        yield name + " [" + subcommands + "]"
+                    else:
+                        yield name
+                elif len(subcommands) > 0:
+                    yield name + " <" + subcommands + ">"
+                # output nothing if no accessible subcommands and _default not accessible
+            elif access >= node.func.access:
+                yield name
+
+    @property
+    def usage(self):
+        """The command and its arguments, without the command prefix"""
+        signature = self.binder.signature
+        return " ".join(self.path) + (" " + signature if signature else "")
+
+    @property
+    def help(self):
+        """The usage and description of the command, without the command prefix"""
+        if self._help is None:
+            self._help = "{}: {}".format(self.usage, self.func.__doc__)
+        return self._help
+
+    def __repr__(self):
+        return "<CommandNode {}>".format(" ".join(self.path))
+
+
+def _add_commands(group, cls):
+    for name, value in inspect.getmembers(cls):
+        if not getattr(value, "_exposed", False):
+            continue
+
+        if inspect.isfunction(value):
+            if value.__name__ == "_default":
+                group.func = value
+                continue
+            node = CommandNode(value.__name__, group.path + (value.__name__,), value)
+        else:
+            node = CommandNode(name, group.path + (name,), group=True)
+            _add_commands(node, value)
+        group.add(node, getattr(value, "_aliases", ()))
+
+def compile_commands(classes):
+    """Compiles the commands exposed by the Commands classes of modules into a trie
+
+    Commands of later classes replace those with the same name in earlier ones.
+    """
+    root = CommandNode("", (), group=True)
+    for cls in classes:
+        _add_commands(root, cls)
+    root.compile()
+    return root
@@ -0,0 +1,250 @@
+#   Waterbug, a modular IRC bot written using Python 3
+#   Copyright (C) 2011  ecryth
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['ConnectionManager', 'Resolver', 'Backoff']
+
+import asyncio
+import itertools
+import logging
+import random
+import socket
+import ssl
+
+# seconds resolved addresses are reused before looking them up again
+DNS_CACHE_TTL = 300
+# seconds to wait for a connection attempt before starting one to the next address
+HAPPY_EYEBALLS_DELAY = 0.25
+# maximum number of servers connecting at the same time
+MAX_CONCURRENT_CONNECTS = 4
+# reconnection delays grow from BACKOFF_BASE up to BACKOFF_CAP seconds
+BACKOFF_BASE = 1
+BACKOFF_CAP = 300
+
+VERIFY_MODES = {"required": ssl.CERT_REQUIRED, "optional": ssl.CERT_OPTIONAL, "none": ssl.CERT_NONE}
+
+
+class Resolver:
+    """Caches resolved addresses, sharing lookups in progress between callers
+
+    If a lookup fails, expired addresses are used rather than failing the connection.
+    """
+
+    def __init__(self, ttl=DNS_CACHE_TTL, *, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.ttl = ttl
+        # (host, port) -> (addresses, expiry time)
+        self.cache = {}
+        self.lookups = {}
+
+    @asyncio.coroutine
+    def resolve(self, host, port):
+        """Returns the getaddrinfo entries of `host`, raises OSError if it can't be resolved"""
+        key = host, port
+        cached = self.cache.get(key)
+        if cached is not None and cached[1] > self.loop.time():
+            return cached[0]
+
+        lookup = self.lookups.get(key)
+        if lookup is None:
+            lookup = self.lookups[key] = asyncio.async(
+                self.loop.getaddrinfo(host, port, type=socket.SOCK_STREAM), loop=self.loop)
+            lookup.add_done_callback(lambda _: self.lookups.pop(key, None))
+
+        try:
+            addresses = yield from asyncio.shield(lookup)
+        except OSError:
+            if cached is None:
+                raise
+            logging.warning("Couldn't resolve %s, using the addresses from the last lookup", host)
+            return cached[0]
+
+        self.cache[key] = addresses, self.loop.time() + self.ttl
+        return addresses
+
+
+def interleave_families(addresses):
+    """Orders addresses alternating between address families, keeping the first family first"""
+    families = {}
+    for address in addresses:
+        families.setdefault(address[0], []).append(address)
+    return [address for group in itertools.zip_longest(*families.values())
+            for address in group if address is not None]
+
+@asyncio.coroutine
+def open_connection(addresses, *, ssl=None, server_hostname=None, delay=HAPPY_EYEBALLS_DELAY,
+                    loop=None):
+    """Connects to the first of the getaddrinfo entries in `addresses` to accept
+
+    Attempts are started `delay` seconds apart, or as soon as the previous one fails, and
+    alternate between IPv6 and IPv4 in the style of happy eyeballs. With an SSLContext in `ssl`,
+    the certificate is verified against `server_hostname`. Returns (reader, writer) or raises
+    OSError if no address could be connected to.
+    """
+    loop = loop or asyncio.get_event_loop()
+    addresses = interleave_families(addresses)
+    pending = set()
+    errors = []
+
+    def first_connection(done):
+        connection = None
+        for attempt in done:
+            if attempt.exception() is not None:
+                errors.append(attempt.exception())
+            elif connection is None:
+                connection = attempt.result()
+            else:
+                attempt.result()[1].close()
+        return connection
+
+    try:
+        for family, _, proto, _, sockaddr in addresses:
+            pending.add(asyncio.async(asyncio.open_connection(
+                sockaddr[0], sockaddr[1], family=family, proto=proto, ssl=ssl,
+                server_hostname=server_hostname if ssl is not None else None, loop=loop),
+                loop=loop))
+            done, pending = yield from asyncio.wait(
+                pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            connection = first_connection(done)
+            if connection is not None:
+                return connection
+
+        while pending:
+            done, pending = yield from asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            connection = first_connection(done)
+            if connection is not None:
+                return connection
+    finally:
+        for attempt in pending:
+            attempt.cancel()
+
+    raise OSError("Couldn't connect to any address: {}".format(
+        ", ".join(str(error) for error in errors) or "no addresses"))
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """An SSLContext that resumes the TLS session of the previous connection
+
+    asyncio can't be given a session to resume, so it's passed on when asyncio wraps the
+    connection. Sessions are only supported from Python 3.6, older versions do full handshakes.
+    """
+
+    session = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, **kwargs):
+        if self.session is not None and not server_side:
+            kwargs.setdefault("session", self.session)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, **kwargs)
+
+    def save_session(self, writer):
+        """Keeps the session of the connection `writer` belongs to for the next connection"""
+        ssl_object = writer.get_extra_info("ssl_object")
+        session = getattr(ssl_object, "session", None)
+        if session is not None:
+            self.session = session
+
+def create_ssl_context(verify="required", ca_file=None, certfile=None, keyfile=None):
+    """Creates the ResumingSSLContext for a server's "tls" config"""
+    context = ResumingSSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+    context.verify_mode = VERIFY_MODES[verify]
+    context.check_hostname = verify == "required"
+    if verify != "none":
+        if ca_file is not None:
+            context.load_verify_locations(ca_file)
+        else:
+            context.load_default_certs()
+    if certfile is not None:
+        context.load_cert_chain(certfile, keyfile)
+    return context
+
+
+class Backoff:
+    """Exponential backoff with full jitter"""
+
+    def __init__(self, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+        self.base = base
+        self.cap = cap
+        self.attempts = 0
+
+    def delay(self):
+        """Returns how long to wait before the next attempt, and counts the attempt"""
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** self.attempts))
+        self.attempts += 1
+        return delay
+
+    def reset(self):
+        self.attempts = 0
+
+
+class ConnectionManager:
+    """Keeps servers connected, reconnecting with backoff
+
+    Addresses are cached in a shared Resolver, and the number of servers connecting at the
+    same time is limited so that starting up with many networks doesn't open all of them at once.
+    """
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_CONNECTS, *, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.resolver = Resolver(loop=self.loop)
+        self.semaphore = asyncio.Semaphore(max_concurrent, loop=self.loop)
+
+    @asyncio.coroutine
+    def manage(self, server):
+        """Connects `server` and reconnects it until it no longer wants to be"""
+        pool_tasks = [asyncio.async(self.manage(connection), loop=self.loop)
+                      for connection in server.pool]
+        try:
+            yield from self._manage(server)
+        finally:
+            # the pool only sends for the primary connection, so it stops with it
+            for connection in server.pool:
+                if connection.connected:
+                    connection.quit()
+                connection.reconnect = False
+            for task in pool_tasks:
+                task.cancel()
+
+    @asyncio.coroutine
+    def _manage(self, server):
+        backoff = Backoff()
+        failures = 0
+        while server.reconnect:
+            try:
+                with (yield from self.semaphore):
+                    yield from server.connect(self.resolver)
+            except (OSError, asyncio.TimeoutError) as e:
+                failures += 1
+                server.logger.warning("Connection attempt failed: %s", str(e) or "timed out")
+                if failures >= server.max_reconnects:
+                    server.logger.warning("Maximum number of connection attempts exceeded, "
+                                          "giving up...")
+                    server.reconnect = False
+                    break
+            else:
+                failures = 0
+                try:
+                    yield from server.run()
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    server.logger.exception("Connection failed unexpectedly")
+                if server.time_to_welcome is not None:
+                    backoff.reset()
+
+            if server.reconnect:
+                delay = backoff.delay()
+                server.logger.info("Reconnecting in %.1f seconds", delay)
+                yield from asyncio.sleep(delay, loop=self.loop)
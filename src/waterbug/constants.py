@@ -1,5 +1,6 @@
 
-__all__ = ["BANNED", "STANDARD", "TRUSTED", "ELEVATED", "OP", "ADMIN"]
+__all__ = ["BANNED", "STANDARD", "TRUSTED", "ELEVATED", "OP", "ADMIN", "ACCESS_LEVELS",
+           "CONTROL", "INTERACTIVE", "BULK"]
 
 BANNED = 0
 STANDARD = 1
@@ -7,3 +8,11 @@ TRUSTED = 2
 ELEVATED = 3
 OP = 4
 ADMIN = 5
+
+ACCESS_LEVELS = {"BANNED": BANNED, "STANDARD": STANDARD, "TRUSTED": TRUSTED,
+                 "ELEVATED": ELEVATED, "OP": OP, "ADMIN": ADMIN}
+
+# outbound message priorities, lower values are sent first
+CONTROL = 0
+INTERACTIVE = 1
+BULK = 2
@@ -17,18 +17,74 @@
 __all__ = ['Server', 'Channel', 'User', 'fetch_url']
 
 import asyncio
+import bisect
 import collections
 import datetime
 import itertools
 import logging
+import re
 import socket
+import sys
 import time
 import traceback
+import types
 
 import aiohttp
 
+from . import connection, protocol
 from .constants import *
 
+READ_CHUNK_SIZE = 2 ** 16
+# 512 bytes for the message itself plus 8191 bytes of IRCv3 message tags
+MAX_LINE_LENGTH = 512 + 8191
+# handle_write waits for the transport buffer to drain below the low mark once above the high mark
+WRITE_BUFFER_HIGH = 2 ** 14
+WRITE_BUFFER_LOW = 2 ** 12
+# number of users outside our channels kept in Server.senders
+MAX_SENDERS = 256
+# default number of lines a single PRIVMSG or NOTICE is split into at most
+MAX_MESSAGE_LINES = 5
+# ends the last line of a message that had to be cut short
+TRUNCATION_MARKER = b" <...>"
+
+# state tracking levels, see Server.tracking_level
+TRACK_NONE = 0
+TRACK_MEMBERS = 1
+TRACK_FULL = 2
+TRACKING_LEVELS = {"none": TRACK_NONE, "members-only": TRACK_MEMBERS, "full": TRACK_FULL}
+
+# seconds WHO requests are collected before they're sent
+WHO_BATCH_DELAY = 0.5
+# seconds to wait for the reply to a WHO
+WHO_TIMEOUT = 10
+# seconds after which autojoin channels the server didn't answer for are given up on
+JOIN_TIMEOUT = 60
+
+# number of raw lines kept in each server's traffic log
+TRAFFIC_LOG_SIZE = 512
+
+# number of round-trip times kept in the lag histogram
+LAG_SAMPLES = 64
+# upper bounds in seconds of the lag histogram buckets, the last bucket takes the rest
+LAG_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+# bulk lines are held back while the lag is above this many seconds
+MAX_BULK_LAG = 10
+# seconds to wait before looking at the queue again when all lines are held back
+LAG_RETRY_DELAY = 1
+# the whole channel is queried instead of its pending users once they are at least this many
+# and make up at least this fraction of its members, as the reply lists every member
+CHANNEL_WHO_THRESHOLD = 10
+CHANNEL_WHO_FRACTION = 0.25
+
+# IRCv3 capabilities requested when available
+WANTED_CAPABILITIES = {"extended-join", "account-notify", "away-notify", "chghost",
+                       "multi-prefix", "userhost-in-names"}
+# capabilities that keep account, hostname and away state of joined users current
+USER_NOTIFICATIONS = {"extended-join", "account-notify", "away-notify", "chghost"}
+
+# marks WHO reply fields that don't carry information, such as the account in a plain WHO
+_UNCHANGED = object()
+
 
 class Server:
 
@@ -36,12 +92,19 @@ class Server:
                  quit_msg=None, ident=None,
                  autojoin=[], privileges=None, inencoding="irc", outencoding="utf8",
                  reconnect=True, max_reconnects=5, connect_timeout=30,
-                 keepalive_interval=60, throttle=1, *, loop=None):
+                 keepalive_interval=60, flood_burst=5, flood_rate=1,
+                 tracking="full", channel_tracking=None, account_ttl=300, tls=None,
+                 pool_size=0, max_message_lines=MAX_MESSAGE_LINES, *, loop=None):
         self.loop = loop or asyncio.get_event_loop()
 
         self.prefix = prefix
-        self.channels = CaseInsensitiveDict()
-        self.users = CaseInsensitiveDict()
+        self.casemapping = protocol.CaseMapping()
+        self.tracking = TRACKING_LEVELS[tracking]
+        self.channel_tracking = protocol.CaseMappedDict(
+            self.casemapping, {channel: TRACKING_LEVELS[level]
+                               for channel, level in (channel_tracking or {}).items()})
+        self.account_ttl = account_ttl
+        self.max_message_lines = max_message_lines
         self.inencoding = inencoding
         self.outencoding = outencoding
         self.name = name
@@ -55,37 +118,94 @@ class Server:
         }
         self.quit_msg = quit_msg or self.username + " quitting..."
         self.autojoin = autojoin
-        self.access_list = privileges or {}
-
-        self.supported = {}
+        self.privileges = PrivilegeMatcher(privileges or {}, self.casemapping)
 
         self.receiver = Server.MessageReceiver(self)
-        self.callbacks = collections.defaultdict(set)
+        # message type -> handler, callbacks and counters; unknown types are added when seen
+        self.dispatch_table = {messagetype: DispatchEntry(handler)
+                               for messagetype, handler in self.receiver.handlers().items()}
 
         self.server = server
         self.port = port
+        # the context is kept between connections so that TLS sessions can be resumed
+        self.ssl_context = connection.create_ssl_context(**tls) if tls is not None else None
+        # authenticate with the client certificate if there is one
+        self.sasl_external = tls is not None and tls.get("certfile") is not None
         self.host = None
-        self.connected = False
-        self.welcomed = False
+        self.connect_started = None
+        self.time_to_welcome = None
+        self.time_to_synced = None
 
         self.reconnect = reconnect
         self.max_reconnects = max_reconnects
         self.connect_timeout = connect_timeout
         self.keepalive_interval = keepalive_interval
-        self.throttle = throttle
-        self.message_queue = asyncio.Queue()
-        self.writer_task = None
+        self.read_timeout = keepalive_interval * 3
+        self.flood_burst = flood_burst
+        self.flood_rate = flood_rate
+        self.queue_wait = 0
+        self.lag_histogram = LagHistogram()
+        # the last raw lines sent and received, as (time, direction, data)
+        self.traffic = collections.deque(maxlen=TRAFFIC_LOG_SIZE)
+        self._init_connection_state()
 
         self.logger = logging.getLogger(name)
 
+        # send-only connections that PRIVMSGs and NOTICEs are spread across, to get around the
+        # flood limits of a single client; they join the same channels but track nothing else
+        self.pool = [Server(prefix, server, port, "{}/{}".format(name, i),
+                            "{}_{}".format(username, i), quit_msg, ident, autojoin,
+                            inencoding=inencoding, outencoding=outencoding, reconnect=reconnect,
+                            max_reconnects=max_reconnects, connect_timeout=connect_timeout,
+                            keepalive_interval=keepalive_interval, flood_burst=flood_burst,
+                            flood_rate=flood_rate, tracking="none", tls=tls,
+                            max_message_lines=max_message_lines, loop=self.loop)
+                     for i in range(1, pool_size + 1)]
+
     @asyncio.coroutine
     def on(self, *messagetypes):
-        future = asyncio.Future()
-        key = self.add_callback(lambda *args: future.set_result(args), messagetypes)
+        """Waits for the next message of any of the given types
+
+        Returns (server, messagetype, sender, *parameters) like the arguments of a callback.
+        """
+        futures = {self.waiters.add(messagetype): messagetype for messagetype in messagetypes}
         try:
-            return (yield from future)
+            done, _ = yield from asyncio.wait(list(futures), return_when=asyncio.FIRST_COMPLETED)
+            future = done.pop()
+            return (self, futures[future]) + future.result()
         finally:
-            self.remove_callback(key)
+            for future, messagetype in futures.items():
+                self.waiters.remove(future, messagetype)
+
+    @asyncio.coroutine
+    def wait_for(self, messagetype, key=None, *, param=1, timeout=None):
+        """Waits for a message of the given type whose parameter number `param` is `key`
+
+        `key` is compared according to the casemapping; if it's None any message of the type
+        matches. `param` defaults to the one following the target of numeric replies, e.g. the
+        mask of a 315. Returns (sender, *parameters), or raises asyncio.TimeoutError.
+        """
+        future = self.waiters.add(messagetype, key, param)
+        try:
+            return (yield from asyncio.wait_for(future, timeout))
+        finally:
+            self.waiters.remove(future, messagetype, key, param)
+
+    @asyncio.coroutine
+    def collect(self, line, replies, end, key, *, param=1, timeout=None):
+        """Sends `line` and collects the replies to it up to its end marker
+
+        The replies are the messages of the types in `replies` received before the message of
+        type `end` whose parameter number `param` is `key`, e.g.
+        collect("WHO #channel", {"352", "354"}, "315", "#channel"). Returns a list of
+        (messagetype, sender, *parameters) tuples, or raises asyncio.TimeoutError.
+        """
+        future = self.waiters.add_collector(replies, end, key, param)
+        self.write(line)
+        try:
+            return (yield from asyncio.wait_for(future, timeout))
+        finally:
+            self.waiters.remove_collector(future, end, key)
 
     def add_callback(self, callback, flags):
         keys = set()
@@ -94,58 +214,127 @@ class Server:
         for flag in flags:
             key = obj, callback, flag, flags
             keys.add(key)
-            self.callbacks[flag].add(key)
+            entry = self.get_dispatch_entry(flag)
+            entry.callbacks += (key,)
         return keys
 
     def remove_callback(self, keys):
         for key in keys:
-            self.callbacks[key[2]].remove(key)
+            entry = self.dispatch_table[key[2]]
+            entry.callbacks = tuple(k for k in entry.callbacks if k != key)
 
     def run_callbacks(self, flag, *parameters):
-        for _, callback, _, _ in self.callbacks[flag]:
+        entry = self.dispatch_table.get(flag)
+        if entry is not None:
+            self._run_callbacks(entry.callbacks, flag, parameters)
+
+    def _run_callbacks(self, callbacks, flag, parameters):
+        for _, callback, _, _ in callbacks:
             try:
                 callback(self, flag, *parameters)
             except Exception:
                 self.logger.exception("Exception while processing callback '%s' with parameters %s",
                                       callback.__name__, parameters)
 
-    def reset_connection(self):
-        self.channels = CaseInsensitiveDict()
-        self.users = CaseInsensitiveDict()
+    def get_dispatch_entry(self, messagetype):
+        entry = self.dispatch_table.get(messagetype)
+        if entry is None:
+            entry = self.dispatch_table[messagetype] = DispatchEntry(None)
+        return entry
+
+    def dump_traffic(self):
+        """Returns the traffic log formatted as lines"""
+        return ["{} {} {}".format(time.strftime("%H:%M:%S", time.localtime(timestamp)), direction,
+                                  protocol.decode(data, self.inencoding))
+                for timestamp, direction, data in self.traffic]
+
+    def message_stats(self):
+        """Returns (message type, count, seconds spent handling) for each message type received,
+        most time consuming first"""
+        return sorted(((messagetype, entry.calls, entry.time)
+                       for messagetype, entry in self.dispatch_table.items() if entry.calls),
+                      key=lambda stat: stat[2], reverse=True)
+
+    def _init_connection_state(self):
+        """Sets up the state that only lasts as long as a connection"""
+        self.channels = protocol.CaseMappedDict(self.casemapping)
+        self.users = protocol.CaseMappedDict(self.casemapping)
+        self.senders = protocol.CaseMappedDict(self.casemapping)
+        self.account_cache = protocol.CaseMappedDict(self.casemapping)
         self.supported = {}
+        self.who_scheduler = WhoScheduler(self)
+        self.waiters = WaiterRegistry(self)
+        self.available_capabilities = set()
+        self.capabilities = set()
+        self.prefix_modes = {"@": "o", "+": "v"}
+        self.prefix_chars = "@+"
+        # NAMES and WHO replies are buffered until the end of the reply
+        self.names_buffer = {}
+        self.who_buffer = []
+        self.ownuser = None
         self.connected = False
         self.welcomed = False
+        # autojoin channels that haven't been joined yet
+        self.pending_joins = protocol.CaseMappedDict(self.casemapping)
+        self.autojoined = False
+        self._join_timeout_handler = None
+        self.message_queue = MessageQueue()
+        self.bucket = TokenBucket(self.flood_burst, self.flood_rate, loop=self.loop)
+        self.writer_task = None
+        self._keepalive_handler = None
+        self.ping_token = None
+        self.ping_sent = None
+
+    def reset_connection(self):
+        self.who_scheduler.cancel()
+        self.waiters.cancel()
+        if self.ssl_context is not None and self.writer is not None:
+            # TLS 1.3 session tickets only arrive after the handshake
+            self.ssl_context.save_session(self.writer)
         self.writer.close()
         if self.writer_task is not None:
             self.writer_task.cancel()
-            self.writer_task = None
-        self.message_queue = asyncio.Queue()
-        self._keepalive_handler.cancel()
+        if self._keepalive_handler is not None:
+            self._keepalive_handler.cancel()
+        if self._join_timeout_handler is not None:
+            self._join_timeout_handler.cancel()
+        self._init_connection_state()
+        self.set_casemapping("rfc1459")
 
     @asyncio.coroutine
-    def connect(self):
-        self.logger.info("Connecting to %s (%s:%s)", self.name, self.server, self.port)
-
-        for attempt in range(self.max_reconnects):
-            if attempt > 0:
-                self.logger.warning("Connection attempt timed out, retrying...")
+    def connect(self, resolver=None):
+        """Opens a connection to the server, trying each of its addresses
 
-            try:
-                self.reader, self.writer = yield from asyncio.wait_for(
-                    asyncio.open_connection(self.server, self.port, loop=self.loop),
-                    self.connect_timeout)
-                self.connected = True
-                break
-            except asyncio.TimeoutError:
-                pass # continue
-        else:
-            # connection attempt failed
-            self.logger.warning("Maximum number of connection attempts exceeded, giving up...")
-            self.reconnect = False
-            return
+        Raises OSError or asyncio.TimeoutError if no connection could be made.
+        """
+        self.logger.info("Connecting to %s (%s:%s)", self.name, self.server, self.port)
+        self.connect_started = self.loop.time()
+        self.time_to_welcome = None
+        self.time_to_synced = None
+
+        resolver = resolver or connection.Resolver(loop=self.loop)
+        addresses = yield from resolver.resolve(self.server, self.port)
+        self.reader, self.writer = yield from asyncio.wait_for(
+            connection.open_connection(addresses, ssl=self.ssl_context,
+                                       server_hostname=self.server, loop=self.loop),
+            self.connect_timeout)
+        self.writer.transport.set_write_buffer_limits(WRITE_BUFFER_HIGH, WRITE_BUFFER_LOW)
+        self.connected = True
+
+        if self.ssl_context is not None:
+            cipher, version, _ = self.writer.get_extra_info("cipher")
+            resumed = getattr(self.writer.get_extra_info("ssl_object"), "session_reused", False)
+            self.logger.info("Connected using %s with %s%s", version, cipher,
+                             ", resumed session" if resumed else "")
+            self.ssl_context.save_session(self.writer)
 
+    @asyncio.coroutine
+    def run(self):
+        """Registers with the server and handles its messages until the connection is lost"""
         self.writer_task = asyncio.async(self.handle_write(), loop=self.loop)
 
+        # registration is held until CAP END by servers that support capability negotiation
+        self.write("CAP LS 302")
         self.nick(self.username)
         self.user(self.ident)
 
@@ -153,104 +342,285 @@ class Server:
 
     @asyncio.coroutine
     def read(self):
-        while True:
-            try:
-                data = yield from asyncio.wait_for(self.reader.readline(),
-                                                   self.keepalive_interval * 3)
-            except asyncio.TimeoutError:
-                self.logger.warning("Read timed out, connection assumed lost")
-                break
-
-            if data[-2:] != b'\r\n':
-                self.logger.warning("Got partial read, connection assumed lost")
-                break
-            else:
-                data = data[:-2]
+        buffer = b""
+        self.message_last_received = self.loop.time()
+        self._read_deadline = self.loop.call_later(self.read_timeout, self.check_read_deadline)
+        try:
+            while True:
+                data = yield from self.reader.read(READ_CHUNK_SIZE)
+                if not data:
+                    if buffer:
+                        self.logger.warning("Got partial read, connection assumed lost")
+                    break
+
+                self.message_last_received = self.loop.time()
+
+                # the last element is either empty or an incomplete line continued by the next chunk
+                lines = (buffer + data).split(b"\r\n")
+                buffer = lines.pop()
+                if len(buffer) > MAX_LINE_LENGTH:
+                    self.logger.warning("Got overlong line, connection assumed lost")
+                    break
+
+                for line in lines:
+                    self.handle_line(line)
+        except OSError as e:
+            # resets, timeouts, unreachable hosts and TLS errors alike
+            self.logger.warning("Connection lost: %s", e)
+        finally:
+            # also when handling a line raised something else, so that nothing of this
+            # connection is left running
+            self._read_deadline.cancel()
+            self.logger.warning("Aborted reading from server")
+            self.reset_connection()
+
+    def check_read_deadline(self):
+        # a single timer per connection, rescheduled lazily instead of a timeout per line
+        idle = self.loop.time() - self.message_last_received
+        if idle >= self.read_timeout:
+            self.logger.warning("Read timed out, connection assumed lost")
+            # makes the pending read return EOF, which ends the read loop
+            self.writer.transport.abort()
+        else:
+            self._read_deadline = self.loop.call_later(self.read_timeout - idle,
+                                                       self.check_read_deadline)
 
-            if self.inencoding == "irc":
-                try:
-                    text = data.decode("utf-8")
-                except UnicodeDecodeError:
-                    text = data.decode("latin", "replace")
-            else:
-                text = data.decode(self.inencoding)
-
-            self.message_last_received = time.time()
-
-            self.logger.debug("<< %s", text)
-
-            if text.startswith(":"):
-                username, msgtype, *parameters = text[1:].split(' ') #remove starting :
-                try:
-                    username, host = username.split('!', 2)
-                except ValueError:
-                    host = None # username keeps its original value
-
-                ident = None
-                access = STANDARD
-                if host is not None:
-                    ident, host = host.split("@", 2)
-                    access = self.access_list.get(host, access)
-
-                if username in self.users:
-                    user = self.users[username]
-                    if host is not None:
-                        user.hostname = host
-                    if ident is not None:
-                        user.ident = ident
-                    user.access = access
-                else:
-                    user = User(username, self, access, ident, host)
+    def handle_line(self, data):
+        self.traffic.append((time.time(), "<<", data))
+        text = protocol.decode(data, self.inencoding)
 
-                for i, v in enumerate(parameters):
-                    if v.startswith(":"):
-                        #remove the : and join together all succeeding parameters
-                        #into one long parameter
-                        parameters[i:] = [' '.join([v[1:]] + parameters[i + 1:])]
-                        break
+        self.logger.debug("<< %s", text)
 
-                try:
-                    could_parse_message = self.receiver(msgtype, user, *parameters)
-                except Exception:
-                    self.logger.exception("Exception while parsing message: %s", text)
+        try:
+            message = protocol.parse(text)
+        except ValueError:
+            self.logger.warning("Got malformed message: %s", text)
+            return
 
-                if could_parse_message:
-                    self.run_callbacks(msgtype, user, *parameters)
+        if message.nick is not None:
+            self.handle_message(message, text)
+        else:
+            self.logger.debug("Server sent: %s", text)
+            if message.command == "PING":
+                self.write("PONG :" + message.params[-1] if message.params else "PONG")
+            elif message.command == "AUTHENTICATE":
+                self.receiver.AUTHENTICATE(None, *message.params)
+
+    def handle_message(self, message, text):
+        username, ident, host = message.nick, message.ident, message.host
+
+        user = self.get_user(username)
+        if user is not None:
+            # a known nick sending from another ident@host may well be someone else, who mustn't
+            # inherit the account of the user we saw last
+            if ((host is not None and user.hostname is not None and user.hostname != host) or
+                    (ident is not None and user.ident is not None and user.ident != ident)):
+                user.reset_account()
+                self.forget_account(username)
+            if host is not None and user.hostname != host:
+                user.hostname = sys.intern(host)
+            if ident is not None and user.ident != ident:
+                user.ident = sys.intern(ident)
+        else:
+            # senders that aren't in any of our channels are kept in a small cache instead of
+            # self.users, so repeated messages from them don't allocate a new User every time
+            user = User(username, self, ident, host)
+            if len(self.senders) >= MAX_SENDERS:
+                self.senders.clear()
+            self.senders[username] = user
+
+        entry = self.get_dispatch_entry(message.command)
+        started = time.perf_counter()
+
+        if entry.handler is None:
+            self.receiver._default(message.command, user, *message.params)
+        else:
+            try:
+                entry.handler(user, *message.params)
+            except Exception:
+                self.logger.exception("Exception while parsing message: %s", text)
             else:
-                self.logger.info("Server sent: %s", text)
-                if text.startswith("PING"):
-                    self.write("PONG " + text.split(' ')[1])
+                self.waiters.dispatch(message.command, user, message.params)
+                if entry.callbacks:
+                    self._run_callbacks(entry.callbacks, message.command,
+                                        [user] + message.params)
+
+        entry.calls += 1
+        entry.time += time.perf_counter() - started
+
+    def get_user(self, nick):
+        """Returns the tracked or recently seen user with the given nick, or None"""
+        user = self.users.get(nick)
+        if user is None:
+            user = self.senders.get(nick)
+        return user
+
+    def set_casemapping(self, name):
+        if name == self.casemapping.name:
+            return
 
-        self.logger.warning("Aborted reading from server")
-        self.reset_connection()
+        self.casemapping.set(name)
+        self.privileges.compile()
+        self.invalidate_access()
+        self.users.rehash()
+        self.senders.rehash()
+        self.channels.rehash()
+        self.channel_tracking.rehash()
+        self.account_cache.rehash()
+        self.who_scheduler.waiting.rehash()
+        self.pending_joins.rehash()
+        self.waiters.rehash()
+        for user in self.users.values():
+            if user.knownchannels:
+                user.knownchannels.rehash()
+        for channel in self.channels.values():
+            channel.users.rehash()
+
+    def set_privilege(self, entry, access):
+        """Gives the users matching a hostname, nick!ident@host mask or $a:account `access`"""
+        self.privileges.set(entry, access)
+        self.invalidate_access()
+
+    def invalidate_access(self):
+        for user in itertools.chain(self.users.values(), self.senders.values()):
+            user.invalidate_access()
+
+    def has_user_notifications(self):
+        """Whether the server keeps us informed about the accounts, hosts and away states of
+        the users in our channels, making WHO unnecessary for them"""
+        return USER_NOTIFICATIONS <= self.capabilities
+
+    def knows_account(self, user):
+        """Whether user.account is known to be current without sending a WHO"""
+        return (self.has_user_notifications() and user.account_known and
+                user.username in self.users and
+                any(self.tracking_level(channel) >= TRACK_FULL for channel in user.knownchannels))
+
+    def tracking_level(self, channel):
+        """Returns how much state is kept about the users of `channel`
+
+        TRACK_NONE keeps nothing but the channel itself, TRACK_MEMBERS keeps its member list
+        and TRACK_FULL additionally keeps hostnames, realnames, accounts and away states.
+        """
+        return self.channel_tracking.get(channel, self.tracking)
 
     def on_welcome(self, host):
         self.host = host
         self.welcomed = True
-
-        # perform autojoins
-        for channel in self.autojoin:
-            self.join(channel)
+        if self.connect_started is not None:
+            self.time_to_welcome = self.loop.time() - self.connect_started
+            self.logger.info("Registered with %s after %.2f seconds", host, self.time_to_welcome)
 
         self._keepalive_handler = self.loop.call_later(self.keepalive_interval, self.keepalive)
 
-    def keepalive(self):
-        if self.host is not None:
-            self.write("PING :{}".format(self.host), log=False)
-
-        self._keepalive_handler = self.loop.call_later(self.keepalive_interval, self.keepalive)
+    def on_motd_end(self):
+        # autojoins wait for the end of the MOTD, by which the ISUPPORT limits are known
+        if not self.welcomed or self.autojoined:
+            return
+        self.autojoined = True
+        self.pending_joins.update(dict.fromkeys(self.autojoin))
+        self.join_many(self.autojoin)
+        if self.pending_joins:
+            self._join_timeout_handler = self.loop.call_later(JOIN_TIMEOUT, self.expire_joins)
+        self.check_synced()
+
+    def expire_joins(self):
+        """Gives up on the autojoin channels the server neither joined us to nor refused"""
+        self._join_timeout_handler = None
+        if self.pending_joins:
+            self.logger.warning("No reply to joining %s", ", ".join(self.pending_joins))
+            self.pending_joins.clear()
+            self.check_synced()
+
+    def check_synced(self):
+        """Reports the time it took to join the autojoin channels and complete their WHOs"""
+        if (self.time_to_synced is None and self.connect_started is not None and self.autojoined
+                and not self.pending_joins and not self.who_scheduler.syncing):
+            self.time_to_synced = self.loop.time() - self.connect_started
+            self.logger.info("Synced %d channels after %.2f seconds",
+                             len(self.channels), self.time_to_synced)
 
-    def msg(self, target, message):
-        self.write("PRIVMSG {} :{}".format(target, message))
+    def keepalive(self):
+        now = self.loop.time()
+        if self.ping_sent is not None and now - self.ping_sent > self.keepalive_interval:
+            self.logger.warning("No PONG for %d seconds, connection assumed lost",
+                                now - self.ping_sent)
+            # makes the pending read return EOF, which ends the read loop
+            self.writer.transport.abort()
+            return
 
-    def notice(self, target, message):
-        self.write("NOTICE {} :{}".format(target, message))
+        if self.ping_sent is None:
+            self.ping()
+
+        # check more often while the server is quiet, so that a dead connection is noticed
+        # long before the read times out
+        interval = self.keepalive_interval
+        if now - self.message_last_received >= self.keepalive_interval / 2:
+            interval /= 4
+        self._keepalive_handler = self.loop.call_later(interval, self.keepalive)
+
+    def ping(self):
+        """Sends a PING tagged with the time it was sent, the PONG records the round-trip time"""
+        self.ping_sent = self.loop.time()
+        self.ping_token = "LAG{:.0f}".format(self.ping_sent * 1000)
+        # written directly rather than queued, so that our own throttling isn't counted as lag
+        self.bucket.consume()
+        data = "PING :{}".format(self.ping_token).encode(self.outencoding)
+        self.traffic.append((time.time(), ">>", data))
+        self.writer.write(data + b"\r\n")
+
+    def pong(self, token):
+        if token != self.ping_token:
+            return
+        rtt = self.loop.time() - self.ping_sent
+        self.ping_token = None
+        self.ping_sent = None
+        self.lag_histogram.add(rtt)
+        self.logger.debug("[Lag] %.3f seconds", rtt)
+
+    @property
+    def lag(self):
+        """The last round-trip time to the server in seconds, or the time an unanswered PING
+        has been waiting if that's longer; None until the first PING was sent"""
+        lag = self.lag_histogram.last
+        if self.ping_sent is not None:
+            waiting = self.loop.time() - self.ping_sent
+            if lag is None or waiting > lag:
+                lag = waiting
+        return lag
+
+    def msg(self, target, message, priority=INTERACTIVE):
+        self.send_text("PRIVMSG", target, message, priority)
+
+    def notice(self, target, message, priority=INTERACTIVE):
+        self.send_text("NOTICE", target, message, priority)
 
     def join(self, channel):
         self.write("JOIN {}".format(channel))
+        for connection in self.pool:
+            if connection.welcomed:
+                connection.join(channel)
+
+    def join_many(self, channels):
+        """Joins channels with as few JOIN lines as the server's TARGMAX and line length allow"""
+        # JOIN always takes comma-separated channels, TARGMAX only limits how many
+        max_targets = self.supported.get("TARGMAX", {}).get("JOIN")
+        room = protocol.MESSAGE_LENGTH - 2 - len("JOIN ")
+        group = []
+        for channel in channels:
+            if group and (len(group) == max_targets or
+                          len(",".join(group + [channel]).encode(self.outencoding)) > room):
+                self.write("JOIN {}".format(",".join(group)))
+                group = []
+            group.append(channel)
+        if group:
+            self.write("JOIN {}".format(",".join(group)))
 
     def part(self, channel):
         self.write("PART {}".format(channel))
+        for connection in self.pool:
+            if connection.welcomed:
+                connection.part(channel)
 
     def nick(self, nick):
         self.write("NICK :{}".format(nick))
@@ -260,37 +630,227 @@ class Server:
                                               ident["servername"], ident["realname"]))
 
     def quit(self):
+        for connection in self.pool:
+            if connection.connected:
+                connection.quit()
+            else:
+                connection.reconnect = False
         self.write("QUIT :{}".format(self.quit_msg))
         self.writer.close()
         self.reconnect = False
 
-    def who(self, mask, extended=True):
+    def connection_for(self, target):
+        """Returns the connection of the pool that sends to `target`
+
+        A target always gets the same connection, which keeps its lines in order. Targets of
+        connections that are down or not in the channel fall back to this, the primary one.
+        """
+        if not self.pool:
+            return self
+        connections = [self] + self.pool
+        connection = connections[hash(self.casemapping.fold(target)) % len(connections)]
+        if not connection.welcomed:
+            return self
+        if (target[:1] in self.supported.get("CHANTYPES", "#&") and
+                target not in connection.channels):
+            return self
+        return connection
+
+    @asyncio.coroutine
+    def resolve_account(self, user):
+        """Returns the services account `user` is logged in as, or None
+
+        Results are cached for account_ttl seconds, or until the user changes nick, quits or
+        leaves our channels. As we don't see that happen for users outside our channels, a
+        cached result is only used for the same nick!ident@host it was looked up for. Raises
+        asyncio.TimeoutError if the WHO isn't answered in time.
+        """
+        if self.knows_account(user):
+            return user.account
+
+        nick = user.username
+        cached = self.account_cache.get(nick)
+        if (cached is not None and cached[3] > self.loop.time() and user.hostname is not None and
+                cached[1:3] == (user.ident, user.hostname)):
+            user.account = cached[0]
+            return user.account
+
+        user = yield from asyncio.wait_for(self.request_who(nick), WHO_TIMEOUT)
+        if user is None:
+            return None
+        self.account_cache[nick] = (user.account, user.ident, user.hostname,
+                                    self.loop.time() + self.account_ttl)
+        return user.account
+
+    def forget_account(self, nick):
+        self.account_cache.pop(nick, None)
+
+    def request_who(self, nick):
+        """Requests a WHO for `nick` through the WhoScheduler, returns a future for its user"""
+        # shielded, as the future is shared between everyone waiting for the same nick
+        return asyncio.shield(self.who_scheduler.request(nick))
+
+    def who(self, mask, extended=True, priority=CONTROL):
         if extended:
-            self.write("WHO {} %uhnfar".format(mask))
+            self.write("WHO {} %uhnfar".format(mask), priority=priority)
         else:
-            self.write("WHO {}".format(mask))
+            self.write("WHO {}".format(mask), priority=priority)
+
+    def write(self, line, priority=CONTROL, target=None):
+        data = protocol.sanitize(line).encode(self.outencoding)
 
-    def write(self, line, log=True):
-        # replace control characters
-        line = "".join("[{}]".format(ord(x)) if ord(x) < 0x20 else x for x in line)
+        if len(data) > protocol.MESSAGE_LENGTH - 2:
+            self.logger.warning("Truncating overlong line: %s", line)
+            data = next(protocol.split_encoded(data, protocol.MESSAGE_LENGTH - 2, self.outencoding))
 
-        maxlength = self.supported.get('TOPICLEN', 300)
-        if len(line) > maxlength:
-            line = "{} {}".format(line[:maxlength], "<...>")
+        self.message_queue.put_nowait((data, self.loop.time()), priority, target)
 
-        self.message_queue.put_nowait((line, log))
+    def send_text(self, command, target, text, priority=INTERACTIVE):
+        """Sends a PRIVMSG or NOTICE, split into as many lines as needed"""
+        connection = self.connection_for(target)
+        if connection is not self:
+            connection.send_text(command, target, text, priority)
+            return
+
+        header = protocol.sanitize("{} {} :".format(command, target)).encode(self.outencoding)
+        data = protocol.sanitize(text).encode(self.outencoding)
+
+        now = self.loop.time()
+        for chunk in self.split_text(data, self.text_length(header)):
+            self.message_queue.put_nowait((header + chunk, now), priority, target)
+
+    def split_text(self, data, limit):
+        """Splits encoded text into lines of at most `limit` bytes
+
+        Text that would take more than max_message_lines lines is cut short, and its last line
+        ends with TRUNCATION_MARKER.
+        """
+        chunks = list(itertools.islice(protocol.split_encoded(data, limit, self.outencoding),
+                                       self.max_message_lines + 1))
+        if len(chunks) > self.max_message_lines:
+            del chunks[self.max_message_lines:]
+            last = next(protocol.split_encoded(chunks[-1], limit - len(TRUNCATION_MARKER),
+                                               self.outencoding), b"")
+            chunks[-1] = last + TRUNCATION_MARKER
+        return chunks
+
+    def broadcast(self, targets, message, command="PRIVMSG", priority=INTERACTIVE):
+        """Sends the same PRIVMSG or NOTICE to several targets in as few lines as allowed
+
+        Targets are packed into comma-separated lists of at most TARGMAX entries per line.
+        """
+        targets = list(collections.OrderedDict.fromkeys(targets))
+        if len(targets) == 0:
+            return
+
+        if self.pool:
+            by_connection = collections.OrderedDict()
+            for target in targets:
+                by_connection.setdefault(self.connection_for(target), []).append(target)
+            if list(by_connection) != [self]:
+                for connection, connection_targets in by_connection.items():
+                    connection.broadcast(connection_targets, message, command, priority)
+                return
+
+        max_targets = self.max_targets(command)
+        data = protocol.sanitize(message).encode(self.outencoding)
+
+        # the server relays the text to each target separately, so it must fit for the longest one
+        longest = max(targets, key=lambda target: len(target.encode(self.outencoding)))
+        header = protocol.sanitize("{} {} :".format(command, longest)).encode(self.outencoding)
+        chunks = self.split_text(data, self.text_length(header))
+        # the line we send carries every target of its group
+        room = protocol.MESSAGE_LENGTH - 2 - len(command) - 3 - max(len(chunk) for chunk in chunks)
+
+        groups = [[]]
+        for target in targets:
+            group = groups[-1]
+            if group and (len(group) == max_targets or
+                          len(",".join(group + [target]).encode(self.outencoding)) > room):
+                group = []
+                groups.append(group)
+            group.append(target)
+
+        now = self.loop.time()
+        for group in groups:
+            target = ",".join(group)
+            header = protocol.sanitize("{} {} :".format(command, target)).encode(self.outencoding)
+            for chunk in chunks:
+                self.message_queue.put_nowait((header + chunk, now), priority, target)
+
+    def max_targets(self, command):
+        """Returns the number of targets `command` accepts, or None if unlimited"""
+        if "TARGMAX" in self.supported:
+            return self.supported["TARGMAX"].get(command, 1)
+        return self.supported.get("MAXTARGETS", 1)
+
+    def text_length(self, header):
+        """Returns the number of bytes left for text after `header` once the server relays it
+
+        The server prepends our own :nick!ident@host prefix when relaying, which counts against
+        the line limit; until our ident and hostname are known, the longest ones are assumed.
+        """
+        ident = hostname = None
+        if self.ownuser is not None:
+            ident, hostname = self.ownuser.ident, self.ownuser.hostname
+        if ident is None:
+            ident = "~" + self.ident["user"][:self.supported.get("USERLEN", 10)]
+        if hostname is None:
+            hostname = "x" * 63
+
+        prefix = ":{}!{}@{} ".format(self.username, ident, hostname).encode(self.outencoding)
+        return protocol.MESSAGE_LENGTH - 2 - len(prefix) - len(header)
+
+    @property
+    def write_buffer_size(self):
+        """Number of bytes written but not yet sent by the transport"""
+        if not self.connected:
+            return 0
+        return self.writer.transport.get_write_buffer_size()
 
     @asyncio.coroutine
     def handle_write(self):
         try:
             while True:
-                line, log = yield from self.message_queue.get()
-                if log:
-                    self.logger.info(">> %s", line)
-                self.writer.write(line.encode(self.outencoding) + b'\r\n')
-                yield from asyncio.sleep(self.throttle)
+                yield from self.message_queue.wait()
+                delay = self.bucket.delay()
+                if delay > 0:
+                    yield from asyncio.sleep(delay)
+
+                # bulk lines wait while the server lags behind, as they would only add to it
+                lag = self.lag
+                max_priority = INTERACTIVE if lag is not None and lag > MAX_BULK_LAG else BULK
+
+                # send everything the bucket currently allows in a single write
+                now = self.loop.time()
+                timestamp = time.time()
+                # decoding lines only to have them discarded by the logger would be wasted work
+                debug = self.logger.isEnabledFor(logging.DEBUG)
+                lines = []
+                while self.bucket.level >= 1:
+                    try:
+                        data, queued = self.message_queue.get_nowait(max_priority)
+                    except asyncio.QueueEmpty:
+                        break
+                    self.bucket.consume()
+                    self.queue_wait = now - queued
+                    self.traffic.append((timestamp, ">>", data))
+                    if debug:
+                        self.logger.debug(">> %s", data.decode(self.outencoding, "replace"))
+                    lines.append(data)
+                    lines.append(b"\r\n")
+
+                if not lines:
+                    yield from asyncio.sleep(LAG_RETRY_DELAY)
+                    continue
+
+                self.writer.writelines(lines)
+                yield from self.writer.drain()
         except asyncio.CancelledError:
             pass
+        except ConnectionError:
+            # the read loop notices the lost connection and resets it
+            self.logger.warning("Connection lost while writing")
 
     class MessageReceiver:
 
@@ -298,55 +858,127 @@ class Server:
             self.server = server
 
         def PRIVMSG(self, sender, target, message):
-            self.server.logger.info("<%s to %s> %s", sender, target, message)
+            self.server.logger.debug("<%s to %s> %s", sender, target, message)
 
         def NOTICE(self, sender, target, message):
-            self.server.logger.info("[NOTICE] <%s to %s> %s", sender, target, message)
+            self.server.logger.debug("[NOTICE] <%s to %s> %s", sender, target, message)
+
+        def JOIN(self, sender, channel, account=None, realname=None):
+            self.server.logger.debug("%s joined channel %s", sender, channel)
 
-        def JOIN(self, sender, channel):
-            self.server.logger.info("%s joined channel %s", sender, channel)
+            if "extended-join" in self.server.capabilities:
+                sender.account = None if account == "*" else account
+                sender.realname = realname
 
+            tracking = self.server.tracking_level(channel)
             if sender is self.server.ownuser:
-                self.server.channels[channel] = Channel(channel)
-                self.server.who(channel)
-            else:
-                self.server.who(sender.username)
+                self.server.channels[channel] = Channel(channel, self.server.casemapping)
+                if tracking >= TRACK_FULL:
+                    self.server.who_scheduler.request_channel(channel)
+                self.server.pending_joins.pop(channel, None)
+                self.server.check_synced()
+            elif tracking == TRACK_NONE:
+                return
+            elif tracking >= TRACK_FULL and not self.server.has_user_notifications():
+                self.server.who_scheduler.request(sender.username)
 
             sender.add_channel(self.server.channels[channel])
 
         def PART(self, sender, channel, message=""):
-            self.server.logger.info("%s parted from channel %s with message %s", sender, channel, message)
+            self.server.logger.debug("%s parted from channel %s with message %s", sender, channel, message)
 
-            sender.remove_channel(self.server.channels[channel])
+            # users of untracked channels aren't known to be members
+            if channel in sender.knownchannels:
+                sender.remove_channel(self.server.channels[channel])
 
         def KICK(self, sender, channel, kickee, message=""):
             self.server.logger.info("%s kicked %s from channel %s with message %s", sender, kickee, channel, message)
-            self.PART(self.server.users[kickee], channel, message)
+            kickee = self.server.get_user(kickee)
+            if kickee is not None:
+                self.PART(kickee, channel, message)
 
         def QUIT(self, sender, message=""):
-            self.server.logger.info("User %s quit with message %s", sender, message)
+            self.server.logger.debug("User %s quit with message %s", sender, message)
 
+            self.server.forget_account(sender.username)
             for channel in sender.knownchannels.values():
                 del channel.users[sender.username]
 
-            del self.server.users[sender.username]
+            if sender.username in self.server.users:
+                del self.server.users[sender.username]
+            self.server.senders.pop(sender.username, None)
 
         def NICK(self, sender, message):
-            self.server.logger.info("User %s changed nick to %s", sender, message)
+            self.server.logger.debug("User %s changed nick to %s", sender, message)
 
+            self.server.forget_account(sender.username)
+            self.server.forget_account(message)
             sender.rename(message)
 
         def TOPIC(self, sender, channel, topic):
-            self.server.logger.info("User %s changed the topic of %s to %s", sender, channel, topic)
+            self.server.logger.debug("User %s changed the topic of %s to %s", sender, channel, topic)
 
             channel = self.server.channels[channel]
             channel.topic = topic
             channel.topicchanger = "{}!{}@{}".format(sender.username, sender.ident, sender.hostname)
             channel.topicchanged = datetime.datetime.now()
 
+        def CAP(self, sender, target, subcommand, *args):
+            server = self.server
+            capabilities = args[-1].split()
+            if subcommand == "LS":
+                server.available_capabilities.update(cap.partition("=")[0] for cap in capabilities)
+                # "*" marks all but the last line of a multi-line reply
+                if args[0] != "*" or len(args) == 1:
+                    wanted = WANTED_CAPABILITIES & server.available_capabilities
+                    if server.sasl_external and "sasl" in server.available_capabilities:
+                        wanted.add("sasl")
+                    if wanted:
+                        server.write("CAP REQ :{}".format(" ".join(sorted(wanted))))
+                    else:
+                        server.write("CAP END")
+            elif subcommand == "ACK":
+                for cap in capabilities:
+                    if cap.startswith("-"):
+                        server.capabilities.discard(cap[1:])
+                    else:
+                        server.capabilities.add(cap)
+                server.logger.info("[CAP] Enabled %s", ", ".join(sorted(server.capabilities)))
+                if not server.welcomed:
+                    if "sasl" in capabilities and server.sasl_external:
+                        # registration continues once authentication has finished
+                        server.write("AUTHENTICATE EXTERNAL")
+                    else:
+                        server.write("CAP END")
+            elif subcommand == "NAK":
+                server.logger.warning("[CAP] Server refused %s", args[-1])
+                if not server.welcomed:
+                    server.write("CAP END")
+            elif subcommand == "DEL":
+                server.capabilities.difference_update(capabilities)
+                server.available_capabilities.difference_update(capabilities)
+
+        def ACCOUNT(self, sender, account):
+            self.server.logger.debug("User %s is now logged in as %s", sender, account)
+            sender.account = None if account == "*" else account
+            self.server.forget_account(sender.username)
+
+        def AWAY(self, sender, message=None):
+            self.server.logger.debug("User %s is %s", sender, "away" if message else "back")
+            sender.away = message is not None
+
+        def CHGHOST(self, sender, ident, host):
+            self.server.logger.debug("User %s is now %s@%s", sender, ident, host)
+            sender.ident = sys.intern(ident)
+            sender.hostname = sys.intern(host)
+
+        def AUTHENTICATE(self, sender, data):
+            if data == "+":
+                # EXTERNAL sends an empty response, the server uses the client certificate
+                self.server.write("AUTHENTICATE +")
+
         def PONG(self, sender, host, message):
-            #self.server.logger.info("[PONG] %s", message)
-            pass
+            self.server.pong(message)
 
         def _001(self, sender, user, message):
             self.server.logger.info("[Welcome] %s", message)
@@ -356,17 +988,17 @@ class Server:
             self.server.on_welcome(sender)
 
         def _002(self, sender, user, message):
-            self.server.logger.info("[Host] %s", message)
+            self.server.logger.debug("[Host] %s", message)
 
         def _003(self, sender, user, message):
-            self.server.logger.info("[Created] %s", message)
+            self.server.logger.debug("[Created] %s", message)
 
         def _004(self, sender, user, host, version, usermodes, chanmodes, *supported):
-            self.server.logger.info("[My Info] I am %s running %s. User modes: %s. Channel modes: %s",
+            self.server.logger.debug("[My Info] I am %s running %s. User modes: %s. Channel modes: %s",
                          host, version, usermodes, chanmodes)
 
         def _005(self, sender, user, *message):
-            self.server.logger.info("[Supported] %s", message)
+            self.server.logger.debug("[Supported] %s", message)
             for i in itertools.islice(message, len(message)-1):
                 a = i.split("=", 2)
                 if len(a) == 2:
@@ -377,97 +1009,156 @@ class Server:
                             a[1] = float(a[1])
                         except ValueError:
                             pass
+                    if a[0] == "TARGMAX":
+                        a[1] = protocol.parse_targmax(a[1])
+                    elif a[0] == "PREFIX":
+                        self.server.prefix_modes = protocol.parse_prefix(a[1])
+                        self.server.prefix_chars = "".join(self.server.prefix_modes)
                     self.server.supported[a[0]] = a[1]
                 else:
                     self.server.supported[a[0]] = True
 
+            if "CASEMAPPING" in self.server.supported:
+                self.server.set_casemapping(self.server.supported["CASEMAPPING"])
+
         def _250(self, sender, user, message):
-            self.server.logger.info("[Statistics] %s", message)
+            self.server.logger.debug("[Statistics] %s", message)
 
         def _251(self, sender, user, message):
-            self.server.logger.info("[Users] %s", message)
+            self.server.logger.debug("[Users] %s", message)
 
         def _252(self, sender, user, op_number, message):
-            self.server.logger.info("[Ops] There are %s IRC Operators online", op_number)
+            self.server.logger.debug("[Ops] There are %s IRC Operators online", op_number)
 
         def _253(self, sender, user, unknown_number, message):
-            self.server.logger.info("[Connections] There are %s unknown connection(s)", unknown_number)
+            self.server.logger.debug("[Connections] There are %s unknown connection(s)", unknown_number)
 
         def _254(self, sender, user, channel_number, message):
-            self.server.logger.info("[Channels] There are %s channels formed", channel_number)
+            self.server.logger.debug("[Channels] There are %s channels formed", channel_number)
 
         def _255(self, sender, user, message):
-            self.server.logger.info("[Clients] %s", message)
+            self.server.logger.debug("[Clients] %s", message)
 
         def _265(self, sender, user, localnumber, localmax, message):
-            self.server.logger.info("[Local] Current local users %s, max %s", localnumber, localmax)
+            self.server.logger.debug("[Local] Current local users %s, max %s", localnumber, localmax)
 
         def _266(self, sender, user, globalnumber, globalmax, message):
-            self.server.logger.info("[Global] Current global users %s, max %s", globalnumber, globalmax)
-
-        def _315(self, sender, target, channel, info):
-            self.server.logger.info("[End of WHO to %s] %s", channel, info)
+            self.server.logger.debug("[Global] Current global users %s, max %s", globalnumber, globalmax)
+
+        def _315(self, sender, target, mask, info):
+            replies, self.server.who_buffer = self.server.who_buffer, []
+            for nick, ident, host, realname, away, account in replies:
+                user = self.server.get_user(nick)
+                if user is None:
+                    continue
+                user.ident = sys.intern(ident)
+                user.hostname = sys.intern(host)
+                user.realname = realname
+                user.away = away
+                if account is not _UNCHANGED:
+                    user.account = account
+                self.server.logger.debug("[Who] %s%s is %s@%s (%s) and %s",
+                                         nick, " (away)" if user.away else "",
+                                         user.ident, user.hostname, user.realname,
+                                         "logged in as {}".format(user.account)
+                                         if user.account is not None else "not logged in")
+
+            self.server.logger.debug("[End of WHO to %s] %d users", mask, len(replies))
+            self.server.who_scheduler.complete(mask)
 
         def _332(self, sender, target, channel, topic):
-            self.server.logger.info("Topic of %s is %s", channel, topic)
+            self.server.logger.debug("Topic of %s is %s", channel, topic)
             self.server.channels[channel].topic = topic
 
         def _333(self, sender, target, channel, person, lastchanged):
-            self.server.logger.info("The topic was last changed %s by %s",
+            self.server.logger.debug("The topic was last changed %s by %s",
                          datetime.datetime.fromtimestamp(int(lastchanged)).isoformat(' '), person)
             self.server.channels[channel].topicchanged = \
                 datetime.datetime.fromtimestamp(int(lastchanged))
             self.server.channels[channel].topicchanger = person
 
         def _352(self, sender, target, channel, ident, host, server, nick, heregone, realname):
-            user = self.server.users[nick]
-            user.ident = ident
-            user.hostname = host
-            user.realname = realname.split(" ", 1)[1]
-            user.away = heregone[0] == 'G'
-            self.server.logger.info("[Who] %s%s in %s is %s@%s (%s)",
-                                    nick, " (away)" if user.away else "", channel,
-                                    user.ident, user.hostname, user.realname)
+            # the hop count precedes the realname
+            self.server.who_buffer.append((nick, ident, host, realname.split(" ", 1)[1],
+                                           heregone[0] == 'G', _UNCHANGED))
 
         def _353(self, sender, target, equalsign, channel, users_on_channel):
-            users = users_on_channel.split(' ')
-            self.server.logger.info("Users currently in %s: %s", channel, users)
+            self.server.logger.debug("Users currently in %s: %s", channel, users_on_channel)
 
-            for username in users:
-                if username[0] in self.server.supported["PREFIX"]:
-                    username = username[1:]
+            if (channel not in self.server.channels or
+                    self.server.tracking_level(channel) == TRACK_NONE):
+                return
 
-                if username in self.server.users:
-                    user = self.server.users[username]
-                else:
-                    user = User(username, self.server)
-
-                user.add_channel(self.server.channels[channel])
+            # applied as one batch once the 366 arrives
+            self.server.names_buffer.setdefault(self.server.casemapping.fold(channel), []) \
+                .extend(users_on_channel.split())
 
         def _354(self, sender, target, ident, host, nick, heregone, account, realname):
-            user = self.server.users[nick]
-            user.ident = ident
-            user.hostname = host
-            user.realname = realname
-            user.away = heregone == 'G'
-            user.account = account if account != '0' else None
-            self.server.logger.info("[Whox] %s%s is %s@%s (%s) and %s",
-                                    nick, " (away)" if user.away else "",
-                                    user.ident, user.hostname, user.realname,
-                                    "logged in as {}".format(user.account)
-                                    if user.account is not None else "not logged in")
+            self.server.who_buffer.append((nick, ident, host, realname, heregone[0] == 'G',
+                                           account if account != '0' else None))
 
         def _366(self, sender, target, channel, message):
-            self.server.logger.info("End of NAMES")
+            names = self.server.names_buffer.pop(self.server.casemapping.fold(channel), None)
+            if names is None:
+                self.server.logger.debug("End of NAMES for %s", channel)
+                return
+
+            channel = self.server.channels[channel]
+            prefix_chars = self.server.prefix_chars
+            for name in names:
+                # names are nick!ident@host with userhost-in-names
+                nick, _, userhost = name.lstrip(prefix_chars).partition("!")
+                user = self.server.get_user(nick)
+                if user is None:
+                    user = User(nick, self.server)
+                if userhost:
+                    ident, _, host = userhost.partition("@")
+                    user.ident = sys.intern(ident)
+                    user.hostname = sys.intern(host)
+                user.add_channel(channel)
+
+            self.server.logger.debug("End of NAMES, %s has %d users", channel, len(names))
 
         def _372(self, sender, target, message):
-            self.server.logger.info("[MOTD] %s", message)
+            self.server.logger.debug("[MOTD] %s", message)
 
         def _375(self, sender, target, message):
-            self.server.logger.info("[MOTD] Message of the day:")
+            self.server.logger.debug("[MOTD] Message of the day:")
 
         def _376(self, sender, target, message):
-            self.server.logger.info("[MOTD] End of message of the day")
+            self.server.logger.debug("[MOTD] End of message of the day")
+            self.server.on_motd_end()
+
+        def _422(self, sender, target, message):
+            self.server.logger.debug("[MOTD] %s", message)
+            self.server.on_motd_end()
+
+        def _900(self, sender, target, mask, account, message):
+            self.server.logger.info("[SASL] Logged in as %s", account)
+
+        def _903(self, sender, target, message):
+            self.server.logger.info("[SASL] Authentication successful")
+            if not self.server.welcomed:
+                self.server.write("CAP END")
+
+        def _904(self, sender, target, message):
+            self.server.logger.warning("[SASL] Authentication failed: %s", message)
+            if not self.server.welcomed:
+                self.server.write("CAP END")
+
+        # too long, aborted and already authenticated end the authentication like a failure
+        _905 = _906 = _907 = _904
+
+        def _471(self, sender, target, channel, *message):
+            # a forward (470) names the channel we're sent to before the message
+            self.server.logger.warning("Couldn't join %s: %s", channel, " ".join(message))
+            self.server.pending_joins.pop(channel, None)
+            self.server.check_synced()
+
+        # no such channel, too many channels, forwarded, invite only, banned, bad key, bad
+        # channel mask, registration needed, illegal name, TLS only and opers only; anything
+        # else is left to expire_joins
+        _403 = _405 = _470 = _473 = _474 = _475 = _476 = _477 = _479 = _489 = _520 = _471
 
         def _433(self, sender, target, nick, message):
             self.server.logger.info("[433] Username %s already in use", nick)
@@ -482,26 +1173,451 @@ class Server:
                 self.server.nick(self.server.username)
 
         def _default(self, msgtype, sender, *message):
-            self.server.logger.info("Unsupported message %s sent by user %s: %s", msgtype, sender, message)
+            self.server.logger.debug("Unsupported message %s sent by user %s: %s", msgtype, sender, message)
+
+        def handlers(self):
+            """Returns a dict from message type to the method handling it; numerics are
+            handled by methods prefixed with an underscore"""
+            handlers = {}
+            for name in dir(type(self)):
+                if name.startswith("__") or name in ("_default", "handlers"):
+                    continue
+                messagetype = name[1:] if name.startswith("_") else name
+                handlers[messagetype] = getattr(self, name)
+            return handlers
 
         def __call__(self, msgtype, *message):
-            f = getattr(self, msgtype, None)
-            if f is None:
-                f = getattr(self, "_" + msgtype, None)
-            if f is None:
+            entry = self.server.dispatch_table.get(msgtype)
+            if entry is None or entry.handler is None:
                 self._default(msgtype, *message)
                 return False
             else:
-                f(*message)
+                entry.handler(*message)
                 return True
 
 
 
+class DispatchEntry:
+    """The handler and callbacks for a message type, with counters of its use"""
+
+    __slots__ = ('handler', 'callbacks', 'calls', 'time')
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.callbacks = ()
+        self.calls = 0
+        self.time = 0.0
+
+
+class WhoScheduler:
+    """Coalesces WHO requests for single users, and paces the WHOs of joined channels
+
+    Requests made in quick succession are deduplicated and sent together: as a channel WHO
+    when the users make up a large part of a channel, as comma-separated masks if the server's
+    TARGMAX allows several WHO targets, or one WHO per user otherwise. Channel WHOs are sent
+    one at a time in the background, after the previous one completed.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        # nick -> future, for users whose WHO hasn't completed yet
+        self.waiting = protocol.CaseMappedDict(server.casemapping)
+        self.queued = []
+        # folded mask -> nicks it was sent for
+        self.in_flight = {}
+        # folded mask -> handle of the timer expiring its nicks if the WHO is never completed
+        self._timeout_handles = {}
+        self._flush_handle = None
+        self.channel_queue = collections.deque()
+        # folded name of the channel whose WHO was sent last, None if none is pending
+        self.channel_in_flight = None
+        self._channel_timeout_handle = None
+        self._channel_replies = 0
+
+    @property
+    def syncing(self):
+        return self.channel_in_flight is not None
+
+    def request_channel(self, channel):
+        """Queues a WHO for everyone in `channel`"""
+        self.channel_queue.append(channel)
+        if self.channel_in_flight is None:
+            self.send_channel()
+
+    def send_channel(self):
+        self.channel_in_flight = None
+        if self._channel_timeout_handle is not None:
+            self._channel_timeout_handle.cancel()
+            self._channel_timeout_handle = None
+        while self.channel_queue:
+            channel = self.channel_queue.popleft()
+            # skip channels that were left while waiting
+            if channel in self.server.channels:
+                self.channel_in_flight = self.server.casemapping.fold(channel)
+                # as bulk, so that syncing many channels doesn't hold up replies to commands
+                self.server.who(channel, priority=BULK)
+                self._channel_replies = len(self.server.who_buffer)
+                self._channel_timeout_handle = self.server.loop.call_later(
+                    WHO_TIMEOUT, self.channel_timed_out)
+                return
+
+    def channel_timed_out(self):
+        """Moves on to the next channel if the WHO of the current one was never completed"""
+        self._channel_timeout_handle = None
+        replies = len(self.server.who_buffer)
+        if replies > self._channel_replies:
+            # the reply of a large channel is still coming in
+            self._channel_replies = replies
+            self._channel_timeout_handle = self.server.loop.call_later(
+                WHO_TIMEOUT, self.channel_timed_out)
+            return
+
+        self.server.logger.warning("WHO for %s timed out", self.channel_in_flight)
+        self.send_channel()
+        self.server.check_synced()
+
+    def request(self, nick):
+        """Returns a future resolved with the user once the WHO reply for `nick` was processed"""
+        future = self.waiting.get(nick)
+        if future is None:
+            future = self.waiting[nick] = asyncio.Future()
+            self.queued.append(nick)
+            if self._flush_handle is None:
+                self._flush_handle = self.server.loop.call_later(WHO_BATCH_DELAY, self.flush)
+        return future
+
+    def flush(self):
+        self._flush_handle = None
+        queued, self.queued = self.queued, []
+
+        by_channel = collections.defaultdict(list)
+        for nick in queued:
+            user = self.server.users.get(nick)
+            if user is not None:
+                for channel in user.knownchannels:
+                    by_channel[channel].append(nick)
+
+        remaining = set(queued)
+        for channel, nicks in sorted(by_channel.items(), key=lambda item: -len(item[1])):
+            nicks = [nick for nick in nicks if nick in remaining]
+            members = len(self.server.channels[channel].users)
+            if len(nicks) >= max(CHANNEL_WHO_THRESHOLD, CHANNEL_WHO_FRACTION * members):
+                self.send(channel, nicks)
+                remaining.difference_update(nicks)
+
+        nicks = [nick for nick in queued if nick in remaining]
+        # only servers listing WHO in TARGMAX accept several comma-separated masks
+        max_targets = self.server.supported.get("TARGMAX", {}).get("WHO", 1) or len(nicks)
+        # leave room for "WHO " and " %uhnfar"
+        room = protocol.MESSAGE_LENGTH - 2 - 12
+        group = []
+        for nick in nicks:
+            if group and (len(group) == max_targets or
+                          len(",".join(group + [nick]).encode(self.server.outencoding)) > room):
+                self.send(",".join(group), group)
+                group = []
+            group.append(nick)
+        if group:
+            self.send(",".join(group), group)
+
+    def send(self, mask, nicks):
+        folded = self.server.casemapping.fold(mask)
+        self.in_flight.setdefault(folded, []).extend(nicks)
+        handle = self._timeout_handles.pop(folded, None)
+        if handle is not None:
+            handle.cancel()
+        self._timeout_handles[folded] = self.server.loop.call_later(WHO_TIMEOUT, self.expire,
+                                                                     folded)
+        self.server.who(mask)
+
+    def expire(self, folded):
+        """Fails the requests of a WHO that was never completed, e.g. after RPL_TRYAGAIN, so
+        that later requests for the same nicks send a new WHO"""
+        self._timeout_handles.pop(folded, None)
+        nicks = self.in_flight.pop(folded, ())
+        if nicks:
+            self.server.logger.warning("WHO for %s timed out", folded)
+        for nick in nicks:
+            future = self.waiting.pop(nick, None)
+            if future is not None and not future.done():
+                future.set_exception(asyncio.TimeoutError())
+                # marked as retrieved, as nobody may be waiting for it any more
+                future.exception()
+
+    def complete(self, mask):
+        """Resolves the requests answered by the WHO for `mask`"""
+        folded = self.server.casemapping.fold(mask)
+        handle = self._timeout_handles.pop(folded, None)
+        if handle is not None:
+            handle.cancel()
+        for nick in self.in_flight.pop(folded, ()):
+            future = self.waiting.pop(nick, None)
+            if future is not None and not future.done():
+                future.set_result(self.server.get_user(nick))
+
+        if folded == self.channel_in_flight:
+            self.send_channel()
+            self.server.check_synced()
+
+    def cancel(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        for future in self.waiting.values():
+            future.cancel()
+        self.waiting.clear()
+        self.queued = []
+        self.in_flight = {}
+        for handle in self._timeout_handles.values():
+            handle.cancel()
+        self._timeout_handles = {}
+        self.channel_queue.clear()
+        self.channel_in_flight = None
+        if self._channel_timeout_handle is not None:
+            self._channel_timeout_handle.cancel()
+            self._channel_timeout_handle = None
+
+
+class WaiterRegistry:
+    """Futures waiting for messages, looked up by message type and the value of a parameter
+
+    A message only resolves the futures waiting for it, so waiting costs nothing for the
+    unrelated messages of the same type. Collectors additionally buffer the replies received
+    before their end marker; as servers answer in order, those belong to the request that
+    the end marker finishes.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        # messagetype -> parameter index, or None for any message -> key -> futures
+        self.waiters = {}
+        # end messagetype -> [parameter index, key -> futures, buffered replies]
+        self.collectors = {}
+        # reply messagetype -> end messagetypes collecting it
+        self.collected = collections.defaultdict(set)
+
+    def add(self, messagetype, key=None, param=1):
+        if key is None:
+            param, key = None, ""
+        by_param = self.waiters.setdefault(messagetype, {})
+        by_key = by_param.get(param)
+        if by_key is None:
+            by_key = by_param[param] = protocol.CaseMappedDict(self.server.casemapping)
+        future = asyncio.Future()
+        by_key.setdefault(key, []).append(future)
+        return future
+
+    def remove(self, future, messagetype, key=None, param=1):
+        if key is None:
+            param, key = None, ""
+        by_param = self.waiters.get(messagetype, {})
+        futures = by_param.get(param, {}).get(key, ())
+        if future in futures:
+            futures.remove(future)
+            if not futures:
+                del by_param[param][key]
+                if not by_param[param]:
+                    del by_param[param]
+                    if not by_param:
+                        del self.waiters[messagetype]
+
+    def add_collector(self, replies, end, key, param=1):
+        collector = self.collectors.get(end)
+        if collector is None:
+            collector = self.collectors[end] = [
+                param, protocol.CaseMappedDict(self.server.casemapping), []]
+        elif collector[0] != param:
+            raise ValueError("{} is already collected by parameter {}".format(end, collector[0]))
+        for reply in replies:
+            self.collected[reply].add(end)
+        future = asyncio.Future()
+        collector[1].setdefault(key, []).append(future)
+        return future
+
+    def remove_collector(self, future, end, key):
+        collector = self.collectors.get(end)
+        if collector is None:
+            return
+        futures = collector[1].get(key, ())
+        if future in futures:
+            futures.remove(future)
+            if not futures:
+                del collector[1][key]
+        if not collector[1]:
+            del self.collectors[end]
+            for reply, ends in list(self.collected.items()):
+                ends.discard(end)
+                if not ends:
+                    del self.collected[reply]
+
+    def dispatch(self, messagetype, sender, params):
+        ends = self.collected.get(messagetype)
+        if ends:
+            for end in ends:
+                self.collectors[end][2].append((messagetype, sender) + tuple(params))
+
+        collector = self.collectors.get(messagetype)
+        if collector is not None:
+            param, by_key, replies = collector
+            collector[2] = []
+            if param < len(params):
+                for future in by_key.pop(params[param], ()):
+                    if not future.done():
+                        future.set_result(replies)
+
+        by_param = self.waiters.get(messagetype)
+        if by_param is None:
+            return
+        result = (sender,) + tuple(params)
+        for param, by_key in list(by_param.items()):
+            if param is None:
+                futures = by_key.pop("", ())
+            elif param < len(params):
+                futures = by_key.pop(params[param], ())
+            else:
+                continue
+            for future in futures:
+                if not future.done():
+                    future.set_result(result)
+            if not by_key:
+                del by_param[param]
+        if not by_param:
+            del self.waiters[messagetype]
+
+    def rehash(self):
+        for by_param in self.waiters.values():
+            for by_key in by_param.values():
+                by_key.rehash()
+        for collector in self.collectors.values():
+            collector[1].rehash()
+
+    def cancel(self):
+        for by_param in self.waiters.values():
+            for by_key in by_param.values():
+                for futures in by_key.values():
+                    for future in futures:
+                        future.cancel()
+        for collector in self.collectors.values():
+            for futures in collector[1].values():
+                for future in futures:
+                    future.cancel()
+        self.waiters = {}
+        self.collectors = {}
+        self.collected.clear()
+
+
+class MessageQueue:
+    """Outbound queue with one lane per priority, each served round-robin between targets
+
+    Lines to the same target keep their order. Only a single consumer may wait on get().
+    """
+
+    def __init__(self):
+        self._lanes = [collections.OrderedDict() for _ in range(BULK + 1)]
+        self._size = 0
+        self._getter = None
+
+    def __len__(self):
+        return self._size
+
+    def put_nowait(self, item, priority=INTERACTIVE, target=None):
+        lane = self._lanes[priority]
+        if target not in lane:
+            lane[target] = collections.deque()
+        lane[target].append(item)
+        self._size += 1
+
+        if self._getter is not None and not self._getter.done():
+            self._getter.set_result(None)
+
+    def get_nowait(self, max_priority=BULK):
+        """Returns the next item with a priority up to `max_priority`"""
+        for lane in self._lanes[:max_priority + 1]:
+            if lane:
+                target, items = next(iter(lane.items()))
+                item = items.popleft()
+                if items:
+                    lane.move_to_end(target)
+                else:
+                    del lane[target]
+                self._size -= 1
+                return item
+        raise asyncio.QueueEmpty
+
+    @asyncio.coroutine
+    def wait(self):
+        """Waits until the queue is non-empty"""
+        while self._size == 0:
+            self._getter = asyncio.Future()
+            yield from self._getter
+
+    @asyncio.coroutine
+    def get(self):
+        yield from self.wait()
+        return self.get_nowait()
+
+
+class TokenBucket:
+    """Allows bursts of up to `size` lines, refilled at `rate` lines per second"""
+
+    def __init__(self, size, rate, *, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.size = size
+        self.rate = rate
+        self._tokens = size
+        self._updated = self.loop.time()
+
+    @property
+    def level(self):
+        now = self.loop.time()
+        self._tokens = min(self.size, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return self._tokens
+
+    def delay(self):
+        """Returns the number of seconds until the next line may be sent"""
+        return max(0, (1 - self.level) / self.rate)
+
+    def consume(self):
+        self._tokens = self.level - 1
+
+
+class LagHistogram:
+    """The last round-trip times to a server, counted in buckets of LAG_BUCKETS"""
+
+    def __init__(self, size=LAG_SAMPLES):
+        self.samples = collections.deque(maxlen=size)
+        self.counts = [0] * (len(LAG_BUCKETS) + 1)
+
+    @property
+    def last(self):
+        return self.samples[-1] if self.samples else None
+
+    def add(self, rtt):
+        if len(self.samples) == self.samples.maxlen:
+            self.counts[bisect.bisect_left(LAG_BUCKETS, self.samples[0])] -= 1
+        self.samples.append(rtt)
+        self.counts[bisect.bisect_left(LAG_BUCKETS, rtt)] += 1
+
+    def percentile(self, percent):
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+    def __str__(self):
+        bounds = ["<{}s".format(bound) for bound in LAG_BUCKETS] + [">{}s".format(LAG_BUCKETS[-1])]
+        return ", ".join("{}: {}".format(bound, count)
+                         for bound, count in zip(bounds, self.counts) if count)
+
+
 class Channel:
 
-    def __init__(self, channelname):
+    __slots__ = ('channelname', 'users', 'topic', 'topicchanged', 'topicchanger', 'modes')
+
+    def __init__(self, channelname, casemapping):
         self.channelname = channelname
-        self.users = CaseInsensitiveDict()
+        self.users = protocol.CaseMappedDict(casemapping)
         self.topic = None
         self.topicchanged = None
         self.topicchanger = None
@@ -510,26 +1626,142 @@ class Channel:
     def __repr__(self):
         return self.channelname
 
+# shared by every user that isn't in any channel or has no known user modes
+_NO_CHANNELS = types.MappingProxyType({})
+_NO_USERMODES = frozenset()
+# the account of users that extended-join, ACCOUNT or WHOX haven't told us about yet
+_UNKNOWN = object()
+
+class PrivilegeMatcher:
+    """Looks up the access of users in a server's privileges
+
+    Entries are hostnames, nick!ident@host masks with * and ? wildcards, or $a:account. Hostnames
+    and accounts are looked up in dicts, and the masks are compiled into one regular expression
+    per access level. A BANNED entry wins over the others, otherwise the highest access does.
+    """
+
+    def __init__(self, privileges, casemapping):
+        self.privileges = dict(privileges)
+        self.casemapping = casemapping
+        self.compile()
+
+    def set(self, entry, access):
+        self.privileges[entry] = access
+        self.compile()
+
+    def compile(self):
+        fold = self.casemapping.fold
+        self.hosts = {}
+        self.accounts = {}
+        masks = collections.defaultdict(list)
+        for entry, access in self.privileges.items():
+            if entry.startswith("$a:"):
+                self.accounts[fold(entry[3:])] = access
+            elif any(c in entry for c in "!@*?"):
+                masks[access].append(protocol.mask_to_regex(fold(protocol.normalize_mask(entry))))
+            else:
+                self.hosts[fold(entry)] = access
+
+        # in the order they're tried, the first one to match decides the access of the masks
+        self.masks = [(access, re.compile("|".join(masks[access])))
+                      for access in sorted(masks, key=lambda access: (access != BANNED, -access))]
+
+    def match(self, user):
+        """Returns the access of `user`, STANDARD if no entry matches"""
+        fold = self.casemapping.fold
+        levels = []
+        if user.account is not None and self.accounts:
+            levels.append(self.accounts.get(fold(user.account), STANDARD))
+        # servers and users only known by nick don't match hostnames or masks
+        if user.hostname is not None:
+            if self.hosts:
+                levels.append(self.hosts.get(fold(user.hostname), STANDARD))
+            if self.masks:
+                hostmask = fold("{}!{}@{}".format(user.username, user.ident, user.hostname))
+                for access, regex in self.masks:
+                    if regex.fullmatch(hostmask):
+                        levels.append(access)
+                        break
+
+        if BANNED in levels:
+            return BANNED
+        return max(levels, default=STANDARD)
+
+
 class User:
 
-    def __init__(self, username, server, access=1, ident=None, hostname=None):
-        self.username = username
-        self.access = access
-        self.ident = ident
-        self.hostname = hostname
+    __slots__ = ('username', '_access', '_ident', '_hostname', 'server', 'knownchannels',
+                 'realname', 'idletime', 'onlinetime', '_account', 'away', 'usermodes')
+
+    def __init__(self, username, server, ident=None, hostname=None):
+        self.username = sys.intern(username)
+        # looked up in the server's privileges when first needed
+        self._access = None
+        self._ident = ident if ident is None else sys.intern(ident)
+        self._hostname = hostname if hostname is None else sys.intern(hostname)
         self.server = server
-        self.knownchannels = CaseInsensitiveDict()
+        self.knownchannels = _NO_CHANNELS
         self.realname = None
         self.idletime = None
         self.onlinetime = None
-        self.account = None
+        self._account = _UNKNOWN
         self.away = None
-        self.usermodes = set()
+        self.usermodes = _NO_USERMODES
+
+    @property
+    def access(self):
+        if self._access is None:
+            self._access = self.server.privileges.match(self)
+        return self._access
+
+    def invalidate_access(self):
+        self._access = None
+
+    # changing what privileges are matched against invalidates the access
+
+    @property
+    def ident(self):
+        return self._ident
+
+    @ident.setter
+    def ident(self, ident):
+        self._ident = ident
+        self._access = None
+
+    @property
+    def hostname(self):
+        return self._hostname
+
+    @hostname.setter
+    def hostname(self, hostname):
+        self._hostname = hostname
+        self._access = None
+
+    @property
+    def account(self):
+        return None if self._account is _UNKNOWN else self._account
+
+    @property
+    def account_known(self):
+        """Whether the account was reported by the server, rather than None for lack of news"""
+        return self._account is not _UNKNOWN
+
+    def reset_account(self):
+        self._account = _UNKNOWN
+        self._access = None
+
+    @account.setter
+    def account(self, account):
+        self._account = account
+        self._access = None
 
     def add_channel(self, channel):
         if self.username not in self.server.users:
             self.server.users[self.username] = self
+            self.server.senders.pop(self.username, None)
 
+        if self.knownchannels is _NO_CHANNELS:
+            self.knownchannels = protocol.CaseMappedDict(self.server.casemapping)
         self.knownchannels[channel.channelname] = channel
         channel.users[self.username] = self
 
@@ -545,14 +1777,25 @@ class User:
             del self.server.channels[channel.channelname]
         else:
             if len(self.knownchannels) == 0:
+                self.knownchannels = _NO_CHANNELS
                 del self.server.users[self.username]
+                self.server.forget_account(self.username)
 
     def rename(self, newnick):
+        if self.username not in self.server.users:
+            # not in any tracked channel; dropped from the sender cache, as we won't see it quit
+            # or change its nick again and whoever uses the new nick next is a stranger to us
+            self.server.senders.pop(self.username, None)
+            self.username = sys.intern(newnick)
+            self._access = None
+            return
+
         del self.server.users[self.username]
         for channel in self.knownchannels.values():
             del channel.users[self.username]
 
-        self.username = newnick
+        self.username = sys.intern(newnick)
+        self._access = None
 
         self.server.users[self.username] = self
         for channel in self.knownchannels.values():
@@ -562,20 +1805,6 @@ class User:
         return self.username
 
 
-class CaseInsensitiveDict(dict):
-        def __setitem__(self, key, value):
-            super().__setitem__(key.lower(), value)
-
-        def __getitem__(self, key):
-            return super().__getitem__(key.lower())
-
-        def __contains__(self, key):
-            return super().__contains__(key.lower())
-
-        def __delitem__(self, key):
-            super().__delitem__(key.lower())
-
-
 @asyncio.coroutine
 def fetch_url(url, *, method="GET", timeout=10, **kwargs):
     res = yield from asyncio.wait_for(aiohttp.request(method, url, **kwargs), timeout)
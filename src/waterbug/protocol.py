@@ -0,0 +1,299 @@
+#   Waterbug, a modular IRC bot written using Python 3
+#   Copyright (C) 2011  ecryth
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['Message', 'CaseMapping', 'CaseMappedDict']
+
+import codecs
+import collections
+import re
+import string
+import sys
+
+# maximum length of a message in bytes, including the trailing CRLF
+MESSAGE_LENGTH = 512
+
+_TAG_ESCAPES = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+_CASEMAPPINGS = {
+    "ascii": str.maketrans(string.ascii_uppercase, string.ascii_lowercase),
+    "rfc1459": str.maketrans(string.ascii_uppercase + "[]\\~", string.ascii_lowercase + "{}|^"),
+    "strict-rfc1459": str.maketrans(string.ascii_uppercase + "[]\\", string.ascii_lowercase + "{}|"),
+}
+# the fold cache is cleared when it grows past this many names
+_FOLD_CACHE_SIZE = 2 ** 16
+
+# control characters are replaced by their code point, e.g. "\n" becomes "[10]"
+_SANITIZE_TABLE = {c: "[{}]".format(c) for c in range(0x20)}
+
+
+class Message:
+
+    __slots__ = ('tags', 'nick', 'ident', 'host', 'command', 'params')
+
+    def __init__(self, command, params, nick=None, ident=None, host=None, tags=None):
+        self.tags = tags
+        self.nick = nick
+        self.ident = ident
+        self.host = host
+        self.command = command
+        self.params = params
+
+    @property
+    def source(self):
+        if self.ident is None:
+            return self.nick
+        return "{}!{}@{}".format(self.nick, self.ident, self.host)
+
+    def __repr__(self):
+        return "Message({!r}, {!r}, source={!r}, tags={!r})".format(
+            self.command, self.params, self.source, self.tags)
+
+
+class CaseMapping:
+    """Folds nicknames and channel names according to the server's CASEMAPPING
+
+    Unknown mappings are treated as rfc1459, the default when the server doesn't advertise one.
+    """
+
+    def __init__(self, name="rfc1459"):
+        self.set(name)
+
+    def set(self, name):
+        self.name = name
+        self._table = _CASEMAPPINGS.get(name, _CASEMAPPINGS["rfc1459"])
+        self._cache = {}
+
+    def fold(self, name):
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+
+        folded = sys.intern(name.translate(self._table))
+        if len(self._cache) >= _FOLD_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[name] = folded
+        return folded
+
+
+class CaseMappedDict(collections.MutableMapping):
+    """A dict with case-insensitive keys according to a CaseMapping
+
+    The key a value was last stored under is kept and returned when iterating. If the
+    casemapping changes, rehash() has to be called.
+    """
+
+    __slots__ = ('casemapping', '_data', '_keys')
+
+    def __init__(self, casemapping, *args, **kwargs):
+        self.casemapping = casemapping
+        self._data = {}
+        # original keys, only for those that differ from their folded form; created on demand
+        self._keys = None
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self._data[self.casemapping.fold(key)]
+
+    def __setitem__(self, key, value):
+        folded = self.casemapping.fold(key)
+        self._data[folded] = value
+        if key != folded:
+            if self._keys is None:
+                self._keys = {}
+            self._keys[folded] = key
+        elif self._keys is not None:
+            self._keys.pop(folded, None)
+
+    def __delitem__(self, key):
+        folded = self.casemapping.fold(key)
+        del self._data[folded]
+        if self._keys is not None:
+            self._keys.pop(folded, None)
+
+    def __contains__(self, key):
+        return self.casemapping.fold(key) in self._data
+
+    def __iter__(self):
+        if self._keys is None:
+            return iter(self._data)
+        keys = self._keys
+        return (keys.get(folded, folded) for folded in self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, dict(self.items()))
+
+    def get(self, key, default=None):
+        return self._data.get(self.casemapping.fold(key), default)
+
+    def values(self):
+        return self._data.values()
+
+    def items(self):
+        return _CaseMappedItemsView(self)
+
+    def clear(self):
+        self._data.clear()
+        self._keys = None
+
+    def copy(self):
+        return type(self)(self.casemapping, self.items())
+
+    def rehash(self):
+        items = list(self.items())
+        self.clear()
+        self.update(items)
+
+
+class _CaseMappedItemsView(collections.ItemsView):
+
+    def __iter__(self):
+        keys = self._mapping._keys
+        if keys is None:
+            return iter(self._mapping._data.items())
+        return ((keys.get(folded, folded), value)
+                for folded, value in self._mapping._data.items())
+
+
+def parse(line):
+    """Parses a decoded line (without the trailing CRLF) into a Message"""
+    tags = None
+    if line[:1] == "@":
+        rawtags, _, line = line.partition(" ")
+        tags = parse_tags(rawtags[1:])
+        line = line.lstrip(" ")
+
+    nick = ident = host = None
+    if line[:1] == ":":
+        source, _, line = line.partition(" ")
+        nick, bang, host = source.partition("!")
+        nick = nick[1:]
+        if bang:
+            ident, _, host = host.partition("@")
+        else:
+            host = None
+
+    # everything after the first " :" is the trailing parameter, which may contain spaces
+    line, colon, trailing = line.partition(" :")
+    params = line.split()
+    if not params:
+        raise ValueError("Message has no command")
+    if colon:
+        params.append(trailing)
+
+    return Message(params.pop(0), params, nick, ident, host, tags)
+
+def parse_tags(rawtags):
+    tags = {}
+    for tag in rawtags.split(";"):
+        key, _, value = tag.partition("=")
+        if "\\" in value:
+            value = _unescape_tag_value(value)
+        tags[key] = value
+    return tags
+
+def _unescape_tag_value(value):
+    unescaped = []
+    chars = iter(value)
+    for c in chars:
+        if c == "\\":
+            c = next(chars, "")
+            c = _TAG_ESCAPES.get(c, c)
+        unescaped.append(c)
+    return "".join(unescaped)
+
+def parse_targmax(value):
+    """Parses an ISUPPORT TARGMAX value such as "PRIVMSG:4,JOIN:" into a dict
+
+    Commands without a limit map to None.
+    """
+    targmax = {}
+    for entry in value.split(","):
+        command, _, limit = entry.partition(":")
+        targmax[command.upper()] = int(limit) if limit else None
+    return targmax
+
+def parse_prefix(value):
+    """Parses an ISUPPORT PREFIX value such as "(ov)@+" into a dict from prefix to mode"""
+    modes, _, prefixes = value[1:].partition(")")
+    return collections.OrderedDict(zip(prefixes, modes))
+
+def normalize_mask(mask):
+    """Completes a hostmask missing its nick or ident part with wildcards"""
+    if "@" not in mask:
+        mask = "*@" + mask if "!" not in mask else mask + "@*"
+    if "!" not in mask:
+        mask = "*!" + mask
+    return mask
+
+def mask_to_regex(mask):
+    """Translates a hostmask with * and ? wildcards into a regular expression"""
+    return "".join(".*" if c == "*" else "." if c == "?" else re.escape(c) for c in mask)
+
+def decode(data, encoding="irc"):
+    """Decodes a raw line; the "irc" encoding tries ASCII, then UTF-8 and falls back to latin-1"""
+    if encoding != "irc":
+        return data.decode(encoding)
+
+    try:
+        return data.decode("ascii")
+    except UnicodeDecodeError:
+        pass
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data.decode("latin-1", "replace")
+
+def sanitize(text):
+    return text.translate(_SANITIZE_TABLE)
+
+def split_encoded(data, limit, encoding="utf-8"):
+    """Splits encoded text into chunks of at most `limit` bytes
+
+    Splits at the last space that leaves the chunk at least half full, otherwise at the last
+    character boundary. The space a chunk is split at is dropped.
+    """
+    utf8 = codecs.lookup(encoding).name == "utf-8"
+
+    while len(data) > limit:
+        cut = data.rfind(b" ", 0, limit + 1)
+        if cut > limit // 2:
+            yield data[:cut]
+            data = data[cut + 1:]
+            continue
+
+        cut = limit
+        if utf8:
+            # back off to the start of a UTF-8 sequence, continuation bytes are 0b10xxxxxx
+            while cut > 0 and data[cut] & 0xC0 == 0x80:
+                cut -= 1
+        else:
+            while cut > 0:
+                try:
+                    data[:cut].decode(encoding)
+                    break
+                except UnicodeDecodeError:
+                    cut -= 1
+        if cut == 0:
+            raise ValueError("Can't split {!r} into chunks of {} bytes".format(data, limit))
+
+        yield data[:cut]
+        data = data[cut:]
+
+    yield data